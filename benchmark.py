@@ -0,0 +1,415 @@
+#!/usr/bin/env python2.7
+
+# Benchmarks brm against a synthetic fleet.
+#
+#   python2.7 benchmark.py generate /tmp/fleet --releases 3 --packages 500
+#   python2.7 benchmark.py run /tmp/fleet --output results.json
+#   python2.7 benchmark.py startup /tmp/fleet --repeat 20
+#
+# "generate" builds a releases root from synthetic OpenWrt build trees and
+# "run" times the common commands against it, printing JSON so results can be
+# compared between versions of brm. "startup" times quick commands that are
+# dominated by interpreter startup and imports.
+
+import argparse
+import json
+import logging
+import os
+import random
+import shutil
+import StringIO
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+
+import experiments
+import groups
+import metrics
+import publish
+import tree
+
+_MAIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+_ARCHITECTURE = 'ar71xx'
+_BUILTIN_FRACTION = 0.6
+
+
+def _tar_gz(members):
+    buf = StringIO.StringIO()
+    handle = tarfile.open(fileobj=buf, mode='w:gz')
+    for name, contents in members:
+        info = tarfile.TarInfo(name)
+        info.size = len(contents)
+        info.mtime = 0
+        handle.addfile(info, StringIO.StringIO(contents))
+    handle.close()
+    return buf.getvalue()
+
+
+def _random_bytes(size, rng):
+    return ('%x' % rng.getrandbits(size * 8)).zfill(size * 2).decode('hex')
+
+
+def _control_contents(name, version, architecture, depends):
+    lines = [
+        'Package: %s' % name,
+        'Version: %s' % version,
+    ]
+    if depends:
+        lines.append('Depends: %s' % ', '.join(depends))
+    lines.extend([
+        'Provides: %s-virtual' % name,
+        'Source: feeds/bismark/%s' % name,
+        'Section: net',
+        'Maintainer: BISmark <bismark-devel@projectbismark.net>',
+        'Architecture: %s' % architecture,
+        'Installed-Size: 4096',
+        'Description: Synthetic package %s for benchmarking' % name,
+        ''
+    ])
+    return '\n'.join(lines)
+
+
+def write_ipk(filename, name, version, architecture, depends, rng):
+    control = _control_contents(name, version, architecture, depends)
+    payload = _random_bytes(rng.randint(1024, 16384), rng)
+    data_tar_gz = _tar_gz([('./usr/bin/%s' % name, payload)])
+    control_tar_gz = _tar_gz([('./control', control)])
+    ipk = _tar_gz([('./debian-binary', '2.0\n'),
+                   ('./data.tar.gz', data_tar_gz),
+                   ('./control.tar.gz', control_tar_gz)])
+    with open(filename, 'wb') as handle:
+        handle.write(ipk)
+    return control
+
+
+def write_build_tree(path, release_name, num_packages, rng):
+    packages_dir = os.path.join(path, 'bin', _ARCHITECTURE, 'packages')
+    info_dir = os.path.join(path,
+                            'build_dir',
+                            'target-mips_r2_uClibc-0.9.33.2',
+                            'root-%s' % _ARCHITECTURE,
+                            'usr', 'lib', 'opkg', 'info')
+    os.makedirs(packages_dir)
+    os.makedirs(info_dir)
+    with open(os.path.join(path, '.config'), 'w') as handle:
+        print >>handle, 'CONFIG_TARGET_%s=y' % _ARCHITECTURE
+
+    image_name = 'openwrt-%s-%s-squashfs-sysupgrade.bin' % (release_name,
+                                                           _ARCHITECTURE)
+    with open(os.path.join(path, 'bin', _ARCHITECTURE, image_name), 'wb') as handle:
+        handle.write(_random_bytes(256 * 1024, rng))
+
+    names = ['bismark-pkg%04d' % i for i in range(num_packages)]
+    num_builtin = int(num_packages * _BUILTIN_FRACTION)
+    for index, name in enumerate(names):
+        depends = []
+        if index > 0:
+            depends.append(names[rng.randint(0, index - 1)])
+        filename = os.path.join(packages_dir, '%s_1.0-1_%s.ipk' % (
+            name, _ARCHITECTURE))
+        control = write_ipk(filename, name, '1.0-1', _ARCHITECTURE, depends, rng)
+        if index < num_builtin:
+            with open(os.path.join(info_dir, '%s.control' % name), 'w') as handle:
+                handle.write(control)
+    return names[:num_builtin]
+
+
+def _node_name(rng):
+    return 'OW%012X' % rng.randint(0, 2 ** 48 - 1)
+
+
+def generate(root,
+             num_releases,
+             num_packages,
+             num_groups,
+             num_nodes,
+             num_experiments,
+             seed):
+    rng = random.Random(seed)
+    timings = {}
+    if os.path.exists(root):
+        raise Exception('%r already exists' % root)
+    releases_root = os.path.join(root, 'releases')
+    builds_root = os.path.join(root, 'builds')
+    releases_tree = tree.BismarkReleasesTree(releases_root)
+
+    nodes = set()
+    while len(nodes) < num_nodes:
+        nodes.add(_node_name(rng))
+    nodes = sorted(nodes)
+    node_groups = groups.NodeGroups(os.path.join(releases_root, 'groups'))
+    group_names = ['group%03d' % i for i in range(num_groups)]
+    for name in group_names:
+        size = rng.randint(1, max(1, num_nodes / 4))
+        node_groups.new_group(name)
+        node_groups.add_nodes(name, rng.sample(nodes, size))
+    node_groups.write_to_files()
+
+    release_names = ['release%02d' % i for i in range(num_releases)]
+    builtin_names = {}
+    for release_name in release_names:
+        build_path = os.path.join(builds_root, release_name)
+        builtin_names[release_name] = write_build_tree(build_path,
+                                                       release_name,
+                                                       num_packages,
+                                                       rng)
+        timings.setdefault('releases_new', []).append(
+            _time_command(releases_root,
+                          ['releases', 'new', release_name, build_path]))
+
+    extras_root = os.path.join(builds_root, 'extras')
+    os.makedirs(extras_root)
+    all_experiments = experiments.Experiments(
+        os.path.join(releases_root, 'experiments'))
+    for index in range(num_experiments):
+        experiment_name = 'Experiment%03d' % index
+        all_experiments.new_experiment(experiment_name,
+                                       'Experiment %d' % index,
+                                       'Synthetic experiment %d' % index)
+        experiment = all_experiments[experiment_name]
+        group = rng.choice(group_names)
+        experiment.set_installed_by_default(rng.choice(group_names), True)
+        if rng.random() < 0.2:
+            experiment.set_required(rng.choice(group_names), True)
+        package_name = 'bismark-experiment%03d' % index
+        for release_name in release_names:
+            filename = os.path.join(extras_root, '%s_%s_1_%s.ipk' % (
+                release_name, package_name, _ARCHITECTURE))
+            write_ipk(filename, package_name, '1', _ARCHITECTURE, [], rng)
+            releases_tree.add_packages(release_name, [filename])
+            experiment.add_package(group,
+                                   release_name,
+                                   package_name,
+                                   '1',
+                                   _ARCHITECTURE)
+    all_experiments.write_to_files()
+
+    for release_name in release_names:
+        upgraded = rng.sample(builtin_names[release_name],
+                              min(5, len(builtin_names[release_name])))
+        for name in upgraded:
+            filename = os.path.join(extras_root, '%s_%s_2.0-1_%s.ipk' % (
+                release_name, name, _ARCHITECTURE))
+            write_ipk(filename, name, '2.0-1', _ARCHITECTURE, [], rng)
+            releases_tree.add_packages(release_name, [filename])
+            releases_tree.upgrade_package(release_name,
+                                          name,
+                                          '2.0-1',
+                                          _ARCHITECTURE,
+                                          rng.choice(group_names))
+
+    signing_key = os.path.join(root, 'signing-key.pem')
+    _make_signing_key(signing_key)
+    _git_snapshot(releases_root)
+    return timings
+
+
+def _make_signing_key(filename):
+    certificate = filename + '.crt'
+    subprocess.check_call(['openssl', 'req', '-x509', '-newkey', 'rsa:1024',
+                           '-nodes', '-keyout', filename, '-out', certificate,
+                           '-subj', '/CN=brm-benchmark', '-days', '365'],
+                          stdout=open(os.devnull, 'w'),
+                          stderr=subprocess.STDOUT)
+    with open(filename, 'a') as handle:
+        with open(certificate) as certificate_handle:
+            handle.write(certificate_handle.read())
+    os.remove(certificate)
+    os.chmod(filename, 0400)
+
+
+def _git_snapshot(releases_root):
+    devnull = open(os.devnull, 'w')
+    subprocess.check_call(['git', 'init', '-q', releases_root], stdout=devnull)
+    subprocess.check_call(['git', 'add', '-A'], cwd=releases_root)
+    subprocess.check_call(['git',
+                           '-c', 'user.name=brm-benchmark',
+                           '-c', 'user.email=brm-benchmark@localhost',
+                           'commit', '-q', '-m', 'benchmark fleet'],
+                          cwd=releases_root,
+                          stdout=devnull)
+
+
+def _time_command(releases_root, arguments):
+    command = [sys.executable, _MAIN, '--root', releases_root] + arguments
+    logging.info('Timing %s', ' '.join(command))
+    with open(os.devnull, 'w') as devnull:
+        start = time.time()
+        subprocess.check_call(command, stdout=devnull)
+        return time.time() - start
+
+
+def _summarize(runs):
+    ordered = sorted(runs)
+    return {
+        'runs': runs,
+        'min': ordered[0],
+        'median': ordered[len(ordered) / 2],
+        'max': ordered[-1],
+    }
+
+
+def _brm_version():
+    source_dir = os.path.dirname(os.path.abspath(__file__))
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(
+                ['git', 'describe', '--always', '--dirty'],
+                cwd=source_dir,
+                stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(root, repeat):
+    releases_root = os.path.join(root, 'releases')
+    signing_key = os.path.join(root, 'signing-key.pem')
+    timings = {}
+    commands = [
+        ('check', ['check']),
+        ('packages_list', ['packages', 'list']),
+        ('diff', ['diff']),
+    ]
+    for name, arguments in commands:
+        timings[name] = [_time_command(releases_root, arguments)
+                         for _ in range(repeat)]
+
+    releases_tree = tree.BismarkReleasesTree(releases_root)
+    destination = tempfile.mkdtemp(prefix='brm-benchmark-destination-')
+    deploy_metrics = None
+    # Keep progress messages from staging and publishing out of the report.
+    stdout = sys.stdout
+    sys.stdout = sys.stderr
+    try:
+        for name in ['deploy_stage', 'deploy_publish']:
+            timings[name] = []
+        for _ in range(repeat):
+            metrics.reset()
+            start = time.time()
+            deployment_path = releases_tree.stage_deployment(signing_key)
+            timings['deploy_stage'].append(time.time() - start)
+            deploy_metrics = metrics.report()
+
+            start = time.time()
+            publish.publish(deployment_path, destination, keep=1)
+            timings['deploy_publish'].append(time.time() - start)
+            shutil.rmtree(deployment_path)
+    finally:
+        sys.stdout = stdout
+        shutil.rmtree(destination)
+
+    results = {}
+    for name, runs in timings.items():
+        results[name] = _summarize(runs)
+    return results, deploy_metrics
+
+
+# Commands that scripts run in tight loops; their cost is mostly startup.
+_STARTUP_COMMANDS = [
+    ('help', ['--help']),
+    ('groups_list', ['groups', 'list']),
+    ('groups_which', ['groups', 'which', 'OW000000000000']),
+    ('releases_list', ['releases', 'list']),
+    ('experiments_list', ['experiments', 'list']),
+]
+
+
+def startup(root, repeat):
+    releases_root = os.path.join(root, 'releases')
+    results = {}
+    for name, arguments in _STARTUP_COMMANDS:
+        results[name] = _summarize([_time_command(releases_root, arguments)
+                                    for _ in range(repeat)])
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark brm against a synthetic fleet')
+    parser.add_argument('--loglevel', dest='loglevel', action='store',
+                        default='WARNING', help='control verbosity of logging')
+    subparsers = parser.add_subparsers(title='commands', dest='command')
+
+    parser_generate = subparsers.add_parser(
+        'generate', help='generate a synthetic releases root')
+    parser_generate.add_argument('root', type=str, action='store',
+                                 help='create the fleet in this directory')
+    parser_generate.add_argument('--releases', type=int, default=2)
+    parser_generate.add_argument('--packages', type=int, default=200,
+                                 help='packages per release')
+    parser_generate.add_argument('--groups', type=int, default=20)
+    parser_generate.add_argument('--nodes', type=int, default=10000)
+    parser_generate.add_argument('--experiments', type=int, default=10)
+    parser_generate.add_argument('--seed', type=int, default=0)
+    parser_run = subparsers.add_parser(
+        'run', help='time brm commands against a synthetic fleet')
+    parser_run.add_argument('root', type=str, action='store',
+                            help='fleet created by "generate"')
+    parser_run.add_argument('--repeat', type=int, default=3, action='store',
+                            help='time each command this many times')
+    parser_run.add_argument('--output', type=str, default=None,
+                            action='store', help='write JSON results here')
+    parser_startup = subparsers.add_parser(
+        'startup', help='time startup of quick brm commands')
+    parser_startup.add_argument('root', type=str, action='store',
+                                help='fleet created by "generate"')
+    parser_startup.add_argument('--repeat', type=int, default=20,
+                                action='store',
+                                help='time each command this many times')
+    parser_startup.add_argument('--output', type=str, default=None,
+                                action='store',
+                                help='write JSON results here')
+
+    args = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s %(message)s',
+                        level=getattr(logging, args.loglevel))
+
+    if args.command == 'generate':
+        timings = generate(args.root,
+                           args.releases,
+                           args.packages,
+                           args.groups,
+                           args.nodes,
+                           args.experiments,
+                           args.seed)
+        report = {
+            'brm_version': _brm_version(),
+            'parameters': {
+                'releases': args.releases,
+                'packages': args.packages,
+                'groups': args.groups,
+                'nodes': args.nodes,
+                'experiments': args.experiments,
+                'seed': args.seed,
+            },
+            'results': dict((name, _summarize(runs))
+                            for name, runs in timings.items()),
+        }
+    elif args.command == 'startup':
+        report = {
+            'brm_version': _brm_version(),
+            'root': os.path.abspath(args.root),
+            'repeat': args.repeat,
+            'results': startup(args.root, args.repeat),
+        }
+    else:
+        results, deploy_metrics = run(args.root, args.repeat)
+        report = {
+            'brm_version': _brm_version(),
+            'root': os.path.abspath(args.root),
+            'repeat': args.repeat,
+            'results': results,
+            'deploy_metrics': deploy_metrics,
+        }
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.command != 'generate' and args.output is not None:
+        with open(args.output, 'w') as handle:
+            print >>handle, output
+    else:
+        print output
+
+if __name__ == '__main__':
+    main()
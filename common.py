@@ -1,11 +1,15 @@
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+import contextlib
 import csv
 import errno
 import hashlib
+import json
 import logging
 import os
+import shutil
 import StringIO
 import sys
+import tempfile
 
 
 def get_fingerprint(filename):
@@ -34,26 +38,126 @@ def makedirs(path):
             raise
 
 
+def _same_file_contents(filename, reference, compare):
+    if not os.path.isfile(reference) or os.path.islink(reference):
+        return False
+    stat = os.stat(filename)
+    reference_stat = os.stat(reference)
+    if stat.st_size != reference_stat.st_size:
+        return False
+    if compare == 'checksum':
+        return get_fingerprint(filename) == get_fingerprint(reference)
+    return int(stat.st_mtime) == int(reference_stat.st_mtime)
+
+
+@contextlib.contextmanager
+def atomic_write(filename):
+    # Write to a temporary file next to filename, then rename it into place,
+    # so readers never see a partially written file.
+    directory = os.path.dirname(filename) or '.'
+    handle = tempfile.NamedTemporaryFile(
+        dir=directory,
+        prefix='.%s.' % os.path.basename(filename),
+        delete=False)
+    try:
+        yield handle
+        handle.close()
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(handle.name, 0666 & ~umask)
+        os.rename(handle.name, filename)
+    except:
+        handle.close()
+        os.remove(handle.name)
+        raise
+
+
+# Hardlink source to destination, or copy it if they're on different
+# filesystems. Returns the number of bytes actually copied.
+def link_or_copy(source, destination):
+    try:
+        os.link(source, destination)
+        return 0
+    except OSError as err:
+        if err.errno not in [errno.EXDEV, errno.EPERM, errno.EMLINK]:
+            raise
+    shutil.copy2(source, destination)
+    return os.path.getsize(destination)
+
+
+# Returns how many bytes removing all of filenames would free. Hardlinked
+# files only free space once every link to them is removed.
+def reclaimable_bytes(filenames):
+    links = defaultdict(int)
+    stats = dict()
+    for filename in set(filenames):
+        stat = os.lstat(filename)
+        key = stat.st_dev, stat.st_ino
+        links[key] += 1
+        stats[key] = stat
+    return sum(stat.st_size
+               for key, stat in stats.iteritems()
+               if links[key] >= stat.st_nlink)
+
+
+# Copy the tree at source to destination, hardlinking files that are
+# unchanged from the same relative path in reference instead of copying them.
+# Returns the number of bytes actually copied.
+def link_tree(source, destination, reference=None, compare='mtime'):
+    bytes_copied = 0
+    makedirs(destination)
+    shutil.copystat(source, destination)
+    for dirpath, dirnames, filenames in os.walk(source):
+        relative_dir = os.path.relpath(dirpath, source)
+        for name in dirnames + filenames:
+            source_path = os.path.join(dirpath, name)
+            relative_path = os.path.normpath(os.path.join(relative_dir, name))
+            destination_path = os.path.join(destination, relative_path)
+            if os.path.islink(source_path):
+                os.symlink(os.readlink(source_path), destination_path)
+            elif os.path.isdir(source_path):
+                makedirs(destination_path)
+                shutil.copystat(source_path, destination_path)
+            elif (reference is not None and
+                    _same_file_contents(source_path,
+                                        os.path.join(reference, relative_path),
+                                        compare)):
+                logging.info('Linking unchanged file %r', relative_path)
+                os.link(os.path.join(reference, relative_path),
+                        destination_path)
+            else:
+                logging.info('Copying %r', relative_path)
+                shutil.copy2(source_path, destination_path)
+                bytes_copied += os.path.getsize(destination_path)
+    return bytes_copied
+
+
 class ColumnFormatter(object):
 
-    def __init__(self, prefix=''):
+    def __init__(self, prefix='', sort=True):
         self._buffer = StringIO.StringIO()
+        self._records = []
         self._prefix = prefix
+        self._sort = sort
 
     def write(self, s):
         self._buffer.write(s)
 
+    def write_record(self, record):
+        self._records.append(tuple(record))
+
     def close(self):
-        lines = self._buffer.getvalue().splitlines()
-        lines.sort()
+        records = self._records
+        for line in self._buffer.getvalue().splitlines():
+            records.append(tuple(line.split()))
+        if self._sort:
+            records.sort()
 
         column_widths = defaultdict(int)
-        for line in lines:
-            words = line.split()
+        for words in records:
             for c, word in enumerate(words):
                 column_widths[c] = max(column_widths[c], len(word))
-        for line in lines:
-            words = line.split()
+        for words in records:
             sys.stdout.write(self._prefix)
             for c, word in enumerate(words):
                 format_string = '%%-%ds' % column_widths[c]
@@ -67,11 +171,76 @@ class ColumnFormatter(object):
         self.close()
 
 
+# The formatters below write each record as soon as it's given to them, so
+# long listings use constant memory and show up immediately in pipelines.
+class _StreamingFormatter(object):
+
+    def __init__(self, fields):
+        self._fields = fields
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+class TsvFormatter(_StreamingFormatter):
+
+    def __init__(self, fields):
+        super(TsvFormatter, self).__init__(fields)
+        print '\t'.join(fields)
+
+    def write_record(self, record):
+        print '\t'.join(record)
+
+
+class JsonLinesFormatter(_StreamingFormatter):
+
+    def write_record(self, record):
+        print json.dumps(OrderedDict(zip(self._fields, record)))
+
+
+class JsonFormatter(_StreamingFormatter):
+
+    def __init__(self, fields):
+        super(JsonFormatter, self).__init__(fields)
+        self._separator = '[\n'
+
+    def write_record(self, record):
+        sys.stdout.write(self._separator)
+        sys.stdout.write(json.dumps(OrderedDict(zip(self._fields, record))))
+        self._separator = ',\n'
+
+    def close(self):
+        if self._separator == '[\n':
+            print '[]'
+        else:
+            print '\n]'
+
+
+_RECORD_FORMATTERS = {
+    'json': JsonFormatter,
+    'jsonl': JsonLinesFormatter,
+    'tsv': TsvFormatter,
+}
+
+
+def record_formatter(output_format, fields, prefix='', sort=True):
+    if output_format == 'columns':
+        return ColumnFormatter(prefix=prefix, sort=sort)
+    return _RECORD_FORMATTERS[output_format](fields)
+
+
 class NamedTupleSet(set):
 
     def __init__(self, tuple_type, filename):
         self._tuple_type = tuple_type
         self._filename = filename
+        self._clean = None
         if os.path.isfile(self._filename):
             self.read_from_file()
 
@@ -80,13 +249,24 @@ class NamedTupleSet(set):
         with open(self._filename) as handle:
             for row in csv.DictReader(handle, delimiter=' '):
                 self.add(self._tuple_type(**row))
+        self._clean = frozenset(self)
+
+    @property
+    def dirty(self):
+        if self._clean is None or not os.path.isfile(self._filename):
+            return True
+        return self != self._clean
 
     def write_to_file(self):
+        if not self.dirty:
+            logging.info('Skipping unchanged file %r', self._filename)
+            return
         logging.info('Writing namedtuple to file %r', self._filename)
-        with open(self._filename, 'w') as handle:
+        with atomic_write(self._filename) as handle:
             writer = csv.DictWriter(handle,
                                     self._tuple_type._fields,
                                     delimiter=' ')
             writer.writeheader()
             for record in sorted(self):
                 writer.writerow(record._asdict())
+        self._clean = frozenset(self)
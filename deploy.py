@@ -1,6 +1,7 @@
 from collections import defaultdict, namedtuple
 import glob
 import gzip
+import hashlib
 import logging
 import os
 import shutil
@@ -10,8 +11,12 @@ import subprocess
 import tempfile
 
 import common
+import metrics
 import opkg
+import publish
 import release as bismark_release
+import snapshots
+import transfer
 
 _NodePackage = namedtuple('NodePackage',
                           ['node', 'name', 'version', 'architecture'])
@@ -24,13 +29,71 @@ class NodePackage(_NodePackage):
         return bismark_release.Package(self.name, self.version, self.architecture)
 
 
+# Generated files get an mtime derived from their contents, so staging
+# the same configuration twice produces identical sizes and mtimes and
+# rsync can skip unchanged files without checksumming them.
+_CONTENT_MTIME_BASE = 946684800  # 2000-01-01 00:00:00 UTC
+_CONTENT_MTIME_RANGE = 1 << 28
+
+_RSYNC_COMPARE_FLAGS = {
+    'checksum': 'c',
+    'mtime': 't',
+}
+
+
 def deploy(releases_root,
            destination,
            signing_key,
            releases,
            experiments,
-           node_groups):
-    deployment_path = tempfile.mkdtemp(prefix='bismark-downloads-staging-')
+           node_groups,
+           compare='checksum',
+           jobs=1,
+           atomic=False,
+           keep_versions=3,
+           snapshots_root=None,
+           keep_snapshots=5):
+    if atomic and not publish.is_local_destination(destination):
+        raise Exception('Atomic publishing requires a local destination')
+
+    deployment_path = stage(releases_root,
+                            signing_key,
+                            releases,
+                            experiments,
+                            node_groups)
+
+    deployed = _publish(deployment_path,
+                        destination,
+                        compare,
+                        jobs,
+                        atomic,
+                        keep_versions)
+    if deployed and snapshots_root is not None:
+        with metrics.phase('save_snapshot'):
+            snapshots.Snapshots(snapshots_root).save(deployment_path,
+                                                     destination,
+                                                     keep_snapshots)
+
+    clean_response = raw_input(
+        '\nDelete staging directory %s? (Y/n) ' % (deployment_path,))
+    if clean_response != 'n':
+        print 'Removing staging directory %s' % (deployment_path,)
+        shutil.rmtree(deployment_path)
+    else:
+        print 'Staging directory %s left intact' % (deployment_path,)
+
+
+def stage(releases_root,
+          signing_key,
+          releases,
+          experiments,
+          node_groups,
+          deployment_path=None):
+    if deployment_path is None:
+        deployment_path = tempfile.mkdtemp(
+            prefix='bismark-downloads-staging-')
+    else:
+        common.makedirs(deployment_path)
     logging.info('staging deployment in %s', deployment_path)
 
     # Fix permissons of the deployment path. mkdtemp gives 700 permissions,
@@ -42,44 +105,98 @@ def deploy(releases_root,
     os.chmod(deployment_path, user_perms | group_perms | other_perms)
 
     for release in releases:
-        _deploy_packages(release, deployment_path)
-        _deploy_images(release, deployment_path)
-        _deploy_builtin_packages(release, deployment_path)
-        _deploy_extra_packages(release, deployment_path)
-        _deploy_upgrades(release, node_groups, deployment_path)
-        _deploy_experiment_packages(release,
-                                    experiments,
-                                    node_groups,
-                                    deployment_path)
-        _deploy_experiment_configurations(release,
-                                          experiments,
-                                          node_groups,
-                                          deployment_path)
-    _make_dummy_directories(deployment_path)
-    _deploy_dummy_experiment_configurations(deployment_path)
-    _deploy_packages_gz(deployment_path)
-    _deploy_packages_sig(deployment_path, signing_key)
-    _deploy_upgradable_sentinels(deployment_path)
-    _deploy_static(releases_root, deployment_path)
-
+        with metrics.phase('deploy_packages'):
+            _deploy_packages(release, deployment_path)
+        with metrics.phase('deploy_images'):
+            _deploy_images(release, deployment_path)
+        with metrics.phase('deploy_builtin_packages'):
+            _deploy_builtin_packages(release, deployment_path)
+        with metrics.phase('deploy_extra_packages'):
+            _deploy_extra_packages(release, deployment_path)
+        with metrics.phase('deploy_upgrades'):
+            _deploy_upgrades(release, node_groups, deployment_path)
+        with metrics.phase('deploy_experiment_packages'):
+            _deploy_experiment_packages(release,
+                                        experiments,
+                                        node_groups,
+                                        deployment_path)
+        with metrics.phase('deploy_experiment_configurations'):
+            _deploy_experiment_configurations(release,
+                                              experiments,
+                                              node_groups,
+                                              deployment_path)
+    with metrics.phase('make_dummy_directories'):
+        _make_dummy_directories(deployment_path)
+    with metrics.phase('deploy_dummy_experiment_configurations'):
+        _deploy_dummy_experiment_configurations(deployment_path)
+    with metrics.phase('deploy_packages_gz'):
+        _deploy_packages_gz(deployment_path)
+    with metrics.phase('deploy_packages_sig'):
+        _deploy_packages_sig(deployment_path, signing_key)
+    with metrics.phase('deploy_upgradable_sentinels'):
+        _deploy_upgradable_sentinels(deployment_path)
+    with metrics.phase('deploy_static'):
+        _deploy_static(releases_root, deployment_path)
+    return deployment_path
+
+
+def rollback(snapshots_root,
+             snapshot_id,
+             destination,
+             compare='checksum',
+             jobs=1,
+             atomic=False,
+             keep_versions=3):
+    deployment_snapshots = snapshots.Snapshots(snapshots_root)
+    if snapshot_id is None:
+        snapshot = deployment_snapshots.previous()
+    else:
+        snapshot = deployment_snapshots[snapshot_id]
+    snapshot.check_manifest()
+    print 'Rolling back to deployment snapshot %s from %s' % (
+        snapshot.id, snapshot.info.get('created'))
+    _publish(snapshot.tree_path,
+             destination,
+             compare,
+             jobs,
+             atomic,
+             keep_versions)
+
+
+def _publish(deployment_path, destination, compare, jobs, atomic,
+             keep_versions):
+    if atomic:
+        diff_destination = os.path.join(destination, 'current')
+    else:
+        diff_destination = destination
     print 'The following files differ at the destination:'
-    diff_success = _diff_from_destination(deployment_path, destination)
+    with metrics.phase('diff_from_destination'):
+        diff_success = _diff_from_destination(deployment_path,
+                                              diff_destination,
+                                              compare)
+    if not diff_success:
+        return False
 
-    if diff_success:
-        deploy_response = raw_input('\nDeploy to %s? (y/N) ' % (destination,))
-        if deploy_response == 'y':
-            print 'Deploying from %s to %s' % (deployment_path, destination)
-            _copy_to_destination(deployment_path, destination)
-        else:
-            print 'Skipping deployment'
+    deploy_response = raw_input('\nDeploy to %s? (y/N) ' % (destination,))
+    if deploy_response != 'y':
+        print 'Skipping deployment'
+        return False
 
-    clean_response = raw_input(
-        '\nDelete staging directory %s? (Y/n) ' % (deployment_path,))
-    if clean_response != 'n':
-        print 'Removing staging directory %s' % (deployment_path,)
-        shutil.rmtree(deployment_path)
-    else:
-        print 'Staging directory %s left intact' % (deployment_path,)
+    print 'Deploying from %s to %s' % (deployment_path, destination)
+    with metrics.phase('copy_to_destination'):
+        if atomic:
+            publish.publish(deployment_path,
+                            destination,
+                            compare,
+                            keep_versions)
+            return True
+        elif jobs > 1:
+            return transfer.parallel_copy(deployment_path,
+                                          destination,
+                                          jobs,
+                                          compare)
+        else:
+            return _copy_to_destination(deployment_path, destination, compare)
 
 
 def _deploy_packages(release, deployment_path):
@@ -93,6 +210,9 @@ def _deploy_packages(release, deployment_path):
         destination_path = os.path.join(destination, package.filename)
         source_filename = os.path.join(packages_path, '%s.ipk' % package.sha1)
         shutil.copy2(source_filename, destination_path)
+        metrics.increment('files_copied')
+        metrics.increment('bytes_copied',
+                          os.path.getsize(destination_path))
 
 
 def _deploy_images(release, deployment_path):
@@ -102,7 +222,11 @@ def _deploy_images(release, deployment_path):
                                        release.name,
                                        image.architecture)
         common.makedirs(destination_dir)
-        shutil.copy2(os.path.join(images_path, image.name), destination_dir)
+        source_filename = os.path.join(images_path, image.name)
+        shutil.copy2(source_filename, destination_dir)
+        metrics.increment('files_copied')
+        metrics.increment('bytes_copied',
+                          os.path.getsize(source_filename))
 
 
 def _deployment_package_paths(release, deployment_path):
@@ -133,6 +257,7 @@ def _deploy_builtin_packages(release, deployment_path):
             link_name = os.path.join(link_dir, os.path.basename(source))
             relative_source = os.path.relpath(source, link_dir)
             os.symlink(relative_source, link_name)
+            metrics.increment('symlinks_created')
 
 
 def _deploy_extra_packages(release, deployment_path):
@@ -149,6 +274,7 @@ def _deploy_extra_packages(release, deployment_path):
             link_name = os.path.join(link_dir, os.path.basename(source))
             relative_source = os.path.relpath(source, link_dir)
             os.symlink(relative_source, link_name)
+            metrics.increment('symlinks_created')
 
 
 def _resolve_groups_to_nodes(node_groups, group_packages):
@@ -162,16 +288,27 @@ def _resolve_groups_to_nodes(node_groups, group_packages):
                                        group_package.architecture)
             node_packages.add(node_package)
 
-    # TODO(sburnett): Change this to pick the latest version instead of
-    # throwing an error.
-    packages_per_node = set()
+    # A node in several groups may be offered several versions of the same
+    # package; it gets the latest one.
+    packages_per_node = dict()
     for package in node_packages:
         key = (package.node, package.name, package.architecture)
         if key in packages_per_node:
-            raise Exception('Conflicting package versions for a node: %s' % (key,))
-        packages_per_node.add(key)
+            other_package = packages_per_node[key]
+            # Equal versions spelled differently (1.0 and 1.00) are broken
+            # by spelling so the choice doesn't depend on set order.
+            if ((opkg.version_key(package.version), package.version) <
+                    (opkg.version_key(other_package.version),
+                     other_package.version)):
+                continue
+            logging.info('Node %r gets version %r of %r instead of %r',
+                         package.node,
+                         package.version,
+                         package.name,
+                         other_package.version)
+        packages_per_node[key] = package
 
-    return node_packages
+    return set(packages_per_node.values())
 
 
 def _normalize_default_packages(node_packages, nodes):
@@ -213,27 +350,27 @@ def _symlink_packages(release, packages, subdirectory, deployment_path):
             link_name = os.path.join(link_dir, os.path.basename(source))
             relative_source = os.path.relpath(source, link_dir)
             os.symlink(relative_source, link_name)
+            metrics.increment('symlinks_created')
 
 
-def _deploy_upgrades(release, node_groups, deployment_path):
+def _upgraded_packages(release, node_groups):
     resolved_upgrades = _resolve_groups_to_nodes(
         node_groups,
         release.package_upgrades)
     nodes = set()
     for node_package in resolved_upgrades:
         nodes.add(node_package.node)
-    upgraded_packages = _normalize_default_packages(resolved_upgrades, nodes)
+    return _normalize_default_packages(resolved_upgrades, nodes)
+
+
+def _deploy_upgrades(release, node_groups, deployment_path):
     _symlink_packages(release,
-                      upgraded_packages,
+                      _upgraded_packages(release, node_groups),
                       'updates-device',
                       deployment_path)
 
 
-def _deploy_experiment_packages(release,
-                                experiments,
-                                node_groups,
-                                deployment_path):
-
+def _experiment_packages(release, experiments, node_groups):
     all_group_packages = set()
     for name, experiment in experiments.iteritems():
         for group_package in experiment.packages:
@@ -247,9 +384,15 @@ def _deploy_experiment_packages(release,
     for _, experiment in experiments.iteritems():
         for group in experiment.header_groups:
             nodes.update(node_groups.resolve_to_nodes(group))
-    normalized_packages = _normalize_default_packages(node_packages, nodes)
+    return _normalize_default_packages(node_packages, nodes)
+
+
+def _deploy_experiment_packages(release,
+                                experiments,
+                                node_groups,
+                                deployment_path):
     _symlink_packages(release,
-                      normalized_packages,
+                      _experiment_packages(release, experiments, node_groups),
                       'experiments-device',
                       deployment_path)
 
@@ -324,17 +467,20 @@ def _normalized_configuration_bodies(release, experiments, node_groups):
                         package.architecture)
                     for architecture in architectures:
                         key = architecture, experiment, package.name
-                        if key in bodies[node] and bodies[node][key] != package.version:
-                            raise Exception(
-                                    'conflicting versions for package in experiment: %s' % (key,))
+                        # Like other packages, a node offered several
+                        # versions through different groups gets the latest.
+                        if key in bodies[node]:
+                            other_version = bodies[node][key]
+                            if ((opkg.version_key(package.version),
+                                 package.version) <
+                                    (opkg.version_key(other_version),
+                                     other_version)):
+                                continue
                         bodies[node][key] = package.version
     return _normalize_default_experiments(bodies)
 
 
-def _deploy_experiment_configurations(release,
-                                      experiments,
-                                      node_groups,
-                                      deployment_path):
+def _experiment_configurations(release, experiments, node_groups):
     normalized_headers = _normalized_configuration_headers(
         experiments, node_groups)
     normalized_bodies = _normalized_configuration_bodies(
@@ -361,7 +507,16 @@ def _deploy_experiment_configurations(release,
                 configurations[architecture, node][experiment] = headers
             configurations[architecture, node][experiment] += (
                 "    list 'package' '%s'\n" % name)
+    return configurations
 
+
+def _deploy_experiment_configurations(release,
+                                      experiments,
+                                      node_groups,
+                                      deployment_path):
+    configurations = _experiment_configurations(release,
+                                                experiments,
+                                                node_groups)
     for (architecture, node), experiments in configurations.items():
         filename = os.path.join(deployment_path,
                                 release.name,
@@ -374,6 +529,8 @@ def _deploy_experiment_configurations(release,
             for name, configuration in sorted(experiments.items()):
                 handle.write(configuration)
                 print >>handle, ''
+        _set_content_mtime(filename)
+        metrics.increment('experiment_configurations_written')
 
 
 def _make_dummy_directories(deployment_path):
@@ -399,6 +556,7 @@ def _deploy_dummy_experiment_configurations(deployment_path):
             experiments_filename = os.path.join(dirname, 'Experiments')
             with open(experiments_filename, 'w') as handle:
                 print >>handle
+            _set_content_mtime(experiments_filename)
 
 
 def _deploy_packages_gz(deployment_path):
@@ -410,18 +568,31 @@ def _deploy_packages_gz(deployment_path):
         '*/*/updates',
         '*/*/updates-device/*',
     ]
+    directories = []
+    filenames = []
     for pattern in patterns:
         full_pattern = os.path.join(deployment_path, pattern)
         for dirname in glob.iglob(full_pattern):
-            package_indices = []
-            for filename in sorted(glob.glob(os.path.join(dirname, '*.ipk'))):
-                package_index = opkg.generate_package_index(filename)
-                package_indices.append(package_index)
-            index_contents = '\n'.join(package_indices)
-            index_filename = os.path.join(dirname, 'Packages.gz')
-            handle = gzip.GzipFile(index_filename, 'wb', mtime=0)
-            handle.write(index_contents)
-            handle.close()
+            directory_filenames = sorted(
+                glob.glob(os.path.join(dirname, '*.ipk')))
+            directories.append((dirname, len(directory_filenames)))
+            filenames.extend(directory_filenames)
+
+    # One batch for the whole deployment, so packages linked into many
+    # directories are only read once.
+    all_indices = opkg.generate_package_indexes(filenames)
+    start = 0
+    for dirname, count in directories:
+        package_indices = all_indices[start:start + count]
+        start += count
+        index_contents = '\n'.join(package_indices)
+        index_filename = os.path.join(dirname, 'Packages.gz')
+        handle = gzip.GzipFile(index_filename, 'wb', mtime=0)
+        handle.write(index_contents)
+        handle.close()
+        _set_content_mtime(index_filename)
+        metrics.increment('indexes_generated')
+        metrics.increment('indexed_packages', len(package_indices))
 
 
 def _deploy_packages_sig(deployment_path, signing_key):
@@ -456,6 +627,14 @@ def _deploy_packages_sig(deployment_path, signing_key):
                 logging.error('openssl smime exited with error code %s',
                               return_code)
                 raise Exception('Error signing Packages.gz')
+            metrics.increment('signatures_made')
+            # Signatures embed a signing time, so their contents change on
+            # every run. Stamp them with the mtime of the index they sign:
+            # if Packages.gz is unchanged then the signature already at the
+            # destination is still valid for it.
+            packages_gz_stat = os.stat(packages_gz_filename)
+            os.utime(packages_sig_filename,
+                     (packages_gz_stat.st_atime, packages_gz_stat.st_mtime))
 
 
 def _deploy_upgradable_sentinels(deployment_path):
@@ -468,8 +647,10 @@ def _deploy_upgradable_sentinels(deployment_path):
         for dirname in glob.iglob(full_pattern):
             if not os.path.isdir(dirname):
                 continue
-            with open(os.path.join(dirname, 'Upgradable'), 'w'):
+            upgradable_filename = os.path.join(dirname, 'Upgradable')
+            with open(upgradable_filename, 'w'):
                 pass
+            _set_content_mtime(upgradable_filename)
 
 
 def _deploy_static(releases_root, deployment_path):
@@ -481,13 +662,24 @@ def _deploy_static(releases_root, deployment_path):
             destination = os.readlink(filename)
             source = os.path.join(deployment_path, os.path.basename(filename))
             os.symlink(destination, source)
+            metrics.increment('symlinks_created')
             continue
         shutil.copy2(filename, deployment_path)
+        metrics.increment('files_copied')
+        metrics.increment('bytes_copied', os.path.getsize(filename))
+
+
+def _set_content_mtime(filename):
+    with open(filename) as handle:
+        digest = hashlib.sha1(handle.read()).hexdigest()
+    mtime = _CONTENT_MTIME_BASE + int(digest, 16) % _CONTENT_MTIME_RANGE
+    logging.info('setting mtime of %r to %d', filename, mtime)
+    os.utime(filename, (mtime, mtime))
 
 
-def _diff_from_destination(deployment_path, destination):
-    command = 'rsync -n -icvlrz --exclude=Packages.sig --delete %s/ %s' % (
-        deployment_path, destination)
+def _diff_from_destination(deployment_path, destination, compare='checksum'):
+    command = 'rsync -n -i%svlrz --exclude=Packages.sig --delete %s/ %s' % (
+        _RSYNC_COMPARE_FLAGS[compare], deployment_path, destination)
     logging.info('Going to run: %s', command)
     return_code = subprocess.call(command, shell=True)
     if return_code != 0:
@@ -496,9 +688,15 @@ def _diff_from_destination(deployment_path, destination):
     return True
 
 
-def _copy_to_destination(deployment_path, destination):
-    command = 'rsync -cvaz --delete %s/ %s' % (deployment_path, destination)
+def _copy_to_destination(deployment_path, destination, compare='checksum'):
+    if compare == 'checksum':
+        flags = '-cvaz'
+    else:
+        flags = '-vaz'
+    command = 'rsync %s --delete %s/ %s' % (flags, deployment_path, destination)
     logging.info('Going to run: %s', command)
     return_code = subprocess.call(command, shell=True)
     if return_code != 0:
         print 'rsync exited with error code %d' % return_code
+        return False
+    return True
@@ -17,6 +17,7 @@ GroupName = namedtuple('GroupName', ['group'])
 
 def new_experiment(root, display_name, description):
     experiment = _Experiment(root)
+    experiment._saved_text = {}
     experiment._display_name = display_name
     experiment._description = description
     return experiment
@@ -44,6 +45,7 @@ class _Experiment(object):
                                               self._get_filename('required'))
         self._revoked = common.NamedTupleSet(GroupName,
                                              self._get_filename('revoked'))
+        self._saved_text = {}
 
     @property
     def name(self):
@@ -152,26 +154,33 @@ class _Experiment(object):
 
     def write_to_files(self):
         common.makedirs(self._root)
-        with open(self._get_filename('description'), 'w') as handle:
-            handle.write(self._description)
-        with open(self._get_filename('display-name'), 'w') as handle:
-            handle.write(self._display_name)
+        self._write_text('description', self._description)
+        self._write_text('display-name', self._display_name)
         self._conflicts.write_to_file()
         self._packages.write_to_file()
         self._installed_by_default.write_to_file()
         self._required.write_to_file()
         self._revoked.write_to_file()
 
+    def _write_text(self, name, contents):
+        filename = self._get_filename(name)
+        if self._saved_text.get(name) == contents and os.path.isfile(filename):
+            logging.info('Skipping unchanged file %r', filename)
+            return
+        logging.info('Writing %r', filename)
+        with common.atomic_write(filename) as handle:
+            handle.write(contents)
+        self._saved_text[name] = contents
+
     def _read_from_files(self):
         with open(self._get_filename('description')) as handle:
             self._description = handle.read()
         with open(self._get_filename('display-name')) as handle:
             self._display_name = handle.read()
-        self._conflicts.read_from_file()
-        self._packages.read_from_file()
-        self._installed_by_default.read_from_file()
-        self._required.read_from_file()
-        self._revoked.read_from_file()
+        self._saved_text = {
+            'description': self._description,
+            'display-name': self._display_name,
+        }
 
     def _get_filename(self, name):
         return os.path.join(self._root, name)
@@ -181,26 +190,38 @@ class Experiments(object):
 
     def __init__(self, root):
         self._root = root
+        self._names = set()
+        # Experiments are opened on first access, so commands that only
+        # touch one experiment (or none) don't parse all of them.
         self._experiments = {}
 
         self._read_from_files()
 
     def __iter__(self):
-        return self._experiments.__iter__()
+        return iter(sorted(self._names))
+
+    def __contains__(self, name):
+        return name in self._names
 
     def __getitem__(self, name):
-        if name not in self._experiments:
+        if name not in self._names:
             raise Exception('experiment does not exist')
+        if name not in self._experiments:
+            logging.info('Opening experiment %r', name)
+            self._experiments[name] = open_experiment(
+                self._experiment_path(name))
         return self._experiments[name]
 
     def iteritems(self):
-        return self._experiments.iteritems()
+        for name in self:
+            yield name, self[name]
 
     def new_experiment(self, name, *rest):
-        if name in self._experiments:
+        if name in self._names:
             raise Exception('experiment already exists')
         experiment_path = self._experiment_path(name)
         self._experiments[name] = new_experiment(experiment_path, *rest)
+        self._names.add(name)
 
     def check_constraints(self):
         self._check_required_experiments_conflict()
@@ -218,8 +239,9 @@ class Experiments(object):
             raise Exception('Required experiments conflict: %r vs %r' % (
                 must_be_installed, cannot_be_installed))
 
-    def write_to_files(self):
-        self.check_constraints()
+    def write_to_files(self, check=True):
+        if check:
+            self.check_constraints()
         for name, experiment in self._experiments.items():
             experiment.write_to_files()
 
@@ -228,8 +250,7 @@ class Experiments(object):
         for dirname in glob.iglob(pattern):
             if not os.path.isdir(dirname):
                 continue
-            name = os.path.basename(dirname)
-            self._experiments[name] = open_experiment(dirname)
+            self._names.add(os.path.basename(dirname))
 
     def _experiment_path(self, name):
         return os.path.join(self._root, name)
@@ -0,0 +1,181 @@
+#!/usr/bin/env python2.7
+
+# Checks that deploy optimizations don't change what routers download.
+#
+#   python2.7 golden.py record ~/bismark-releases golden.json -k KEY
+#   python2.7 golden.py check ~/bismark-releases golden.json -k KEY --engine atomic
+#
+# "record" stages a deployment and writes a canonical listing of it: every
+# path, symlink target and file hash, plus the decompressed contents of each
+# Packages.gz. "check" produces the same listing using one of the deploy
+# engines below and reports any difference from the recorded listing.
+
+import argparse
+import gzip
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+import common
+import publish
+import snapshots
+import transfer
+import tree
+
+# Signatures embed the signing time, so only their presence is compared.
+_UNHASHED_FILES = set(['Packages.sig'])
+
+
+def canonical_listing(deployment_path):
+    listing = []
+    for dirpath, dirnames, filenames in os.walk(deployment_path):
+        for name in dirnames + filenames:
+            path = os.path.join(dirpath, name)
+            record = {'path': os.path.relpath(path, deployment_path)}
+            if os.path.islink(path):
+                record['type'] = 'symlink'
+                record['target'] = os.readlink(path)
+            elif os.path.isdir(path):
+                record['type'] = 'directory'
+            elif name in _UNHASHED_FILES:
+                record['type'] = 'signature'
+            else:
+                record['type'] = 'file'
+                record['sha1'] = common.get_fingerprint(path)
+                if name == 'Packages.gz':
+                    handle = gzip.open(path)
+                    try:
+                        record['index'] = handle.read().split('\n')
+                    finally:
+                        handle.close()
+            listing.append(record)
+    listing.sort(key=lambda record: record['path'])
+    return listing
+
+
+def compare_listings(expected, actual):
+    differences = []
+    expected_records = dict((r['path'], r) for r in expected)
+    actual_records = dict((r['path'], r) for r in actual)
+    for path in sorted(set(expected_records) | set(actual_records)):
+        if path not in actual_records:
+            differences.append('missing: %s' % path)
+        elif path not in expected_records:
+            differences.append('unexpected: %s' % path)
+        elif expected_records[path] != actual_records[path]:
+            expected_record = expected_records[path]
+            actual_record = actual_records[path]
+            for key in sorted(set(expected_record) | set(actual_record)):
+                if key == 'index':
+                    continue
+                if expected_record.get(key) != actual_record.get(key):
+                    differences.append('%s: %s is %r, expected %r' % (
+                        path, key, actual_record.get(key),
+                        expected_record.get(key)))
+            if expected_record.get('index') != actual_record.get('index'):
+                differences.append('%s: index contents differ' % path)
+    return differences
+
+
+def _engine_stage(releases_tree, signing_key, scratch):
+    return releases_tree.stage_deployment(signing_key,
+                                          os.path.join(scratch, 'staging'))
+
+
+def _engine_atomic(releases_tree, signing_key, scratch):
+    deployment_path = _engine_stage(releases_tree, signing_key, scratch)
+    destination = os.path.join(scratch, 'destination')
+    # Publish twice so the second version is built from hardlinks.
+    publish.publish(deployment_path, destination)
+    return publish.publish(deployment_path, destination)
+
+
+def _engine_snapshot(releases_tree, signing_key, scratch):
+    deployment_path = _engine_stage(releases_tree, signing_key, scratch)
+    deployment_snapshots = snapshots.Snapshots(os.path.join(scratch,
+                                                            'snapshots'))
+    deployment_snapshots.save(deployment_path, 'golden', 2)
+    snapshot = deployment_snapshots.save(deployment_path, 'golden', 2)
+    snapshot.check_manifest()
+    return snapshot.tree_path
+
+
+def _engine_parallel(releases_tree, signing_key, scratch):
+    deployment_path = _engine_stage(releases_tree, signing_key, scratch)
+    destination = os.path.join(scratch, 'destination')
+    common.makedirs(destination)
+    if not transfer.parallel_copy(deployment_path, destination, 4, 'mtime'):
+        raise Exception('Parallel transfer failed')
+    return destination
+
+
+ENGINES = {
+    'stage': _engine_stage,
+    'atomic': _engine_atomic,
+    'snapshot': _engine_snapshot,
+    'parallel': _engine_parallel,
+}
+
+
+def listing_for_engine(root, signing_key, engine):
+    releases_tree = tree.BismarkReleasesTree(root)
+    scratch = tempfile.mkdtemp(prefix='brm-golden-')
+    # Engines print progress; keep it away from our own output.
+    stdout = sys.stdout
+    sys.stdout = sys.stderr
+    try:
+        result_path = ENGINES[engine](releases_tree, signing_key, scratch)
+        return canonical_listing(result_path)
+    finally:
+        sys.stdout = stdout
+        shutil.rmtree(scratch)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compare deploy engines against a golden listing')
+    subparsers = parser.add_subparsers(title='commands', dest='command')
+    parser_record = subparsers.add_parser(
+        'record', help='record a golden listing')
+    parser_check = subparsers.add_parser(
+        'check', help='check an engine against a golden listing')
+    for subparser in [parser_record, parser_check]:
+        subparser.add_argument('root', type=str, action='store',
+                               help='releases root to deploy')
+        subparser.add_argument('golden', type=str, action='store',
+                               help='golden listing file')
+        subparser.add_argument('-k', '--signingkey', type=str,
+                               default='~/.bismark_signing_key.pem',
+                               action='store',
+                               help='sign Packages.gz with this key')
+        subparser.add_argument('--engine', type=str, default='stage',
+                               choices=sorted(ENGINES), action='store',
+                               help='deploy engine to run')
+    args = parser.parse_args()
+
+    root = os.path.expanduser(args.root)
+    listing = listing_for_engine(root, args.signingkey, args.engine)
+    if args.command == 'record':
+        with open(args.golden, 'w') as handle:
+            json.dump(listing, handle, indent=1, sort_keys=True)
+        print 'Recorded %d entries in %s' % (len(listing), args.golden)
+        return
+
+    with open(args.golden) as handle:
+        expected = json.load(handle)
+    # json gives us unicode strings; normalize both sides the same way.
+    actual = json.loads(json.dumps(listing))
+    differences = compare_listings(expected, actual)
+    for difference in differences:
+        print difference
+    if differences:
+        print '%d differences from %s' % (len(differences), args.golden)
+        sys.exit(1)
+    print 'Engine %r matches %s (%d entries)' % (args.engine,
+                                                  args.golden,
+                                                  len(listing))
+
+if __name__ == '__main__':
+    main()
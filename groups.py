@@ -1,46 +1,288 @@
+from collections import defaultdict
 import errno
 import glob
 import logging
 import os
+import re
+
+import common
+
+# Derived groups are defined by expressions over other groups:
+#
+#   expression := term (('|' | '-') term)*
+#   term       := atom ('&' atom)*
+#   atom       := GROUP | '(' expression ')'
+#
+# '|' is union, '&' is intersection and '-' is difference. '&' binds tighter
+# than '|' and '-', which apply left to right. Since group names often
+# contain dashes, '-' is only an operator when it stands alone, e.g.
+# "atlanta-routers - testbed".
+_EXPRESSION_TOKEN = re.compile(r'[()|&]|[^\s()|&]+')
+
+
+def parse_expression(text):
+    tokens = _EXPRESSION_TOKEN.findall(text)
+    position = [0]
+
+    def peek():
+        if position[0] < len(tokens):
+            return tokens[position[0]]
+        return None
+
+    def take():
+        token = peek()
+        if token is None:
+            raise Exception('Unexpected end of group expression %r' % text)
+        position[0] += 1
+        return token
+
+    def parse_atom():
+        token = take()
+        if token == '(':
+            node = parse_union()
+            if take() != ')':
+                raise Exception('Missing ")" in group expression %r' % text)
+            return node
+        if token in [')', '|', '&', '-']:
+            raise Exception('Unexpected %r in group expression %r' % (
+                token, text))
+        return ('group', token)
+
+    def parse_term():
+        node = parse_atom()
+        while peek() == '&':
+            take()
+            node = ('&', node, parse_atom())
+        return node
+
+    def parse_union():
+        node = parse_term()
+        while peek() in ['|', '-']:
+            operator = take()
+            node = (operator, node, parse_term())
+        return node
+
+    expression = parse_union()
+    if peek() is not None:
+        raise Exception('Unexpected %r in group expression %r' % (
+            peek(), text))
+    return expression
+
+
+def expression_groups(expression):
+    if expression[0] == 'group':
+        return set([expression[1]])
+    return expression_groups(expression[1]) | expression_groups(expression[2])
 
 
 class NodeGroups(object):
     _reserved_groups = set(['default'])
 
-    def __init__(self, root):
+    def __init__(self, root, derived_root=None):
         self._root = root
+        self._derived_root = derived_root
         self._groups = dict()
+        self._node_groups = defaultdict(set)
         self._groups_to_delete = set()
+        self._dirty_groups = set()
+        self._derived = dict()
+        self._parsed = dict()
+        self._derived_to_delete = set()
+        self._dirty_derived = set()
+        self._resolved = dict()
+        self._resolving = set()
 
         self._read_from_files()
 
     def __iter__(self):
-        return self._groups.__iter__()
+        return iter(self._groups.keys() + self._derived.keys())
+
+    def __contains__(self, name):
+        return name in self._groups or name in self._derived
 
     def __getitem__(self, name):
-        return self._groups[name]
+        if name not in self:
+            raise KeyError(name)
+        return self.resolve_to_nodes(name)
 
     def __delitem__(self, name):
+        for other_name in self._derived:
+            if other_name == name:
+                continue
+            if name in expression_groups(self._parsed_expression(other_name)):
+                raise Exception('Group %r is used by derived group %r' % (
+                    name, other_name))
+        if name in self._derived:
+            del self._derived[name]
+            self._parsed.pop(name, None)
+            self._derived_to_delete.add(name)
+            self._dirty_derived.discard(name)
+            self._resolved.clear()
+            logging.info('Deleted derived group %r', name)
+            return
+        for node in self._groups[name]:
+            self._remove_from_index(node, name)
         del self._groups[name]
         self._groups_to_delete.add(name)
+        self._dirty_groups.discard(name)
+        self._resolved.clear()
         logging.info('Deleted group %r', name)
 
     def new_group(self, name):
         if name in self._reserved_groups:
             raise Exception('that group name is reserved')
-        if name in self._groups:
+        if name in self:
             raise Exception('group already exists')
         self._groups[name] = set()
         self._groups_to_delete.discard(name)
+        self._dirty_groups.add(name)
+        self._resolved.clear()
         logging.info('Created new group %r', name)
 
+    def define_group(self, name, text):
+        if self._derived_root is None:
+            raise Exception('Derived groups are not supported here')
+        if name in self._reserved_groups:
+            raise Exception('that group name is reserved')
+        if name in self._groups:
+            raise Exception('%r is already a group of nodes' % name)
+        expression = parse_expression(text)
+        for group in expression_groups(expression):
+            if group not in self:
+                raise Exception('Unknown group %r in expression %r' % (
+                    group, text))
+        previous = self._derived.get(name)
+        self._derived[name] = text
+        self._parsed[name] = expression
+        self._resolved.clear()
+        try:
+            self.resolve_to_nodes(name)
+        except:
+            if previous is None:
+                del self._derived[name]
+            else:
+                self._derived[name] = previous
+            self._parsed.pop(name, None)
+            self._resolved.clear()
+            raise
+        self._derived_to_delete.discard(name)
+        self._dirty_derived.add(name)
+        logging.info('Defined group %r as %r', name, text)
+
+    def is_derived(self, name):
+        return name in self._derived
+
+    def expression(self, name):
+        return self._derived[name]
+
+    def _plain_group(self, name):
+        if name in self._derived:
+            raise Exception('%r is a derived group; change its expression '
+                            'instead of its nodes' % name)
+        return self._groups[name]
+
+    def add_nodes(self, name, nodes):
+        group = self._plain_group(name)
+        for node in nodes:
+            if node in group:
+                continue
+            group.add(node)
+            self._node_groups[node].add(name)
+            self._dirty_groups.add(name)
+        self._resolved.clear()
+
+    def remove_nodes(self, name, nodes):
+        group = self._plain_group(name)
+        nodes = list(nodes)
+        # Check every node first so a missing one leaves the group unchanged.
+        for node in nodes:
+            if node not in group:
+                raise KeyError(node)
+        for node in set(nodes):
+            group.remove(node)
+            self._remove_from_index(node, name)
+            self._dirty_groups.add(name)
+        self._resolved.clear()
+
+    def discard_nodes(self, name, nodes):
+        group = self._plain_group(name)
+        for node in nodes:
+            if node not in group:
+                continue
+            group.remove(node)
+            self._remove_from_index(node, name)
+            self._dirty_groups.add(name)
+        self._resolved.clear()
+
+    def replace_nodes(self, name, nodes):
+        nodes = set(nodes)
+        self.discard_nodes(name, self._plain_group(name) - nodes)
+        self.add_nodes(name, nodes)
+
+    def intersect_nodes(self, name, nodes):
+        nodes = set(nodes)
+        self.discard_nodes(name, self._plain_group(name) - nodes)
+
+    def groups_containing(self, node):
+        names = set(self._node_groups.get(node, ()))
+        for name in self._derived:
+            if node in self.resolve_to_nodes(name):
+                names.add(name)
+        return frozenset(names)
+
     def resolve_to_nodes(self, group_or_node):
+        # Deploy resolves the same groups once per package and experiment,
+        # so results are kept until the next mutation.
+        if group_or_node in self._resolved:
+            return self._resolved[group_or_node]
         if group_or_node in self._groups:
             logging.info('resolving %r to a set of nodes', group_or_node)
-            return self._groups[group_or_node]
+            nodes = frozenset(self._groups[group_or_node])
+        elif group_or_node in self._derived:
+            logging.info('evaluating derived group %r', group_or_node)
+            if group_or_node in self._resolving:
+                raise Exception('Derived group %r refers to itself' % (
+                    group_or_node,))
+            self._resolving.add(group_or_node)
+            try:
+                nodes = self._evaluate(
+                    group_or_node, self._parsed_expression(group_or_node))
+            finally:
+                self._resolving.discard(group_or_node)
         else:
             logging.info('resolving %r to a single node', group_or_node)
-            return set([group_or_node])
+            nodes = frozenset([group_or_node])
+        self._resolved[group_or_node] = nodes
+        return nodes
+
+    def _parsed_expression(self, name):
+        if name not in self._parsed:
+            self._parsed[name] = parse_expression(self._derived[name])
+        return self._parsed[name]
+
+    def _evaluate(self, name, expression):
+        operator = expression[0]
+        if operator == 'group':
+            if expression[1] not in self:
+                raise Exception('Derived group %r refers to unknown group %r'
+                                % (name, expression[1]))
+            return self.resolve_to_nodes(expression[1])
+        left = self._evaluate(name, expression[1])
+        right = self._evaluate(name, expression[2])
+        if operator == '|':
+            return left | right
+        elif operator == '&':
+            return left & right
+        else:
+            return left - right
+
+    def _remove_from_index(self, node, name):
+        names = self._node_groups.get(node)
+        if names is None:
+            return
+        names.discard(name)
+        if not names:
+            del self._node_groups[node]
 
     def write_to_files(self):
         logging.info('Writing groups in %r', self._root)
@@ -51,13 +293,13 @@ class NodeGroups(object):
             if err.errno != errno.EEXIST:
                 raise
             logging.info('Groups directory %r already exists', self._root)
-        for name, nodes in self._groups.items():
+        for name in sorted(self._dirty_groups):
             filename = os.path.join(self._root, name)
             logging.info('Writing group %r to %r', name, filename)
-            with open(filename, 'w') as handle:
-                for node in sorted(nodes):
+            with common.atomic_write(filename) as handle:
+                for node in sorted(self._groups[name]):
                     print >>handle, node
-                    logging.info('Wrote node %r for group %r', node, name)
+        self._dirty_groups.clear()
         logging.info('Removing deleted group files')
         for name in self._groups_to_delete:
             filename = os.path.join(self._root, name)
@@ -67,6 +309,29 @@ class NodeGroups(object):
             except OSError as e:
                 if e.errno != errno.ENOENT:
                     raise
+        self._groups_to_delete.clear()
+        self._write_derived_groups()
+
+    def _write_derived_groups(self):
+        if self._derived_root is None:
+            return
+        if self._dirty_derived:
+            common.makedirs(self._derived_root)
+        for name in sorted(self._dirty_derived):
+            filename = os.path.join(self._derived_root, name)
+            logging.info('Writing derived group %r to %r', name, filename)
+            with common.atomic_write(filename) as handle:
+                print >>handle, self._derived[name]
+        self._dirty_derived.clear()
+        for name in self._derived_to_delete:
+            filename = os.path.join(self._derived_root, name)
+            logging.info('Removing derived group file %r', filename)
+            try:
+                os.remove(filename)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+        self._derived_to_delete.clear()
 
     def _read_from_files(self):
         pattern = os.path.join(self._root, '*')
@@ -83,3 +348,20 @@ class NodeGroups(object):
                     node = line.strip()
                     logging.info('Reading node %r for group %r', node, name)
                     self._groups[name].add(node)
+                    self._node_groups[node].add(name)
+        self._read_derived_groups()
+
+    def _read_derived_groups(self):
+        if self._derived_root is None:
+            return
+        pattern = os.path.join(self._derived_root, '*')
+        logging.info('Reading derived groups from %r', pattern)
+        for filename in glob.iglob(pattern):
+            if not os.path.isfile(filename):
+                continue
+            name = os.path.basename(filename)
+            with open(filename) as handle:
+                self._derived[name] = handle.read().strip()
+            if name in self._groups:
+                raise Exception('%r is both a group and a derived group' % (
+                    name,))
@@ -3,9 +3,30 @@
 import argparse
 import logging
 import os
+import sys
 
 import subcommands
-import tree
+
+
+def _positive_integer(text):
+    try:
+        value = int(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError('%r is not an integer' % text)
+    if value < 1:
+        raise argparse.ArgumentTypeError('%r must be at least 1' % text)
+    return value
+
+
+def _percentage(text):
+    try:
+        percent = float(text.rstrip('%'))
+    except ValueError:
+        raise argparse.ArgumentTypeError('%r is not a percentage' % text)
+    if not 0 < percent <= 100:
+        raise argparse.ArgumentTypeError('%r is not between 0%% and 100%%' %
+                                         text)
+    return percent
 
 
 def create_groups_subcommands(subparsers):
@@ -19,12 +40,21 @@ def create_groups_subcommands(subparsers):
         'list-all', help='list all groups of nodes')
     parser_list_all_groups.set_defaults(handler=subcommands.list_all_groups)
 
+    parser_which_groups = subparsers.add_parser(
+        'which', help='list groups that contain a node')
+    parser_which_groups.add_argument(
+        'node', type=str, action='store', help='name of the node')
+    parser_which_groups.set_defaults(handler=subcommands.which_groups)
+
     parser_new_group = subparsers.add_parser(
         'new', help='create a new group of nodes')
     parser_new_group.add_argument(
         'name', type=str, action='store', help='name of the new group')
     parser_new_group.add_argument(
         'node', nargs='*', type=str, action='store', help='nodes to add')
+    parser_new_group.add_argument(
+        '-f', '--file', type=str, default=None, action='store',
+        help='also add nodes listed in this file, one per line ("-" for stdin)')
     parser_new_group.set_defaults(handler=subcommands.new_group)
 
     parser_copy_group = subparsers.add_parser(
@@ -35,6 +65,16 @@ def create_groups_subcommands(subparsers):
         'new_name', type=str, action='store', help='name of the new copy')
     parser_copy_group.set_defaults(handler=subcommands.copy_group)
 
+    parser_define_group = subparsers.add_parser(
+        'define', help='define a group as an expression over other groups')
+    parser_define_group.add_argument(
+        'name', type=str, action='store', help='name of the derived group')
+    parser_define_group.add_argument(
+        'expression', nargs='+', type=str, action='store',
+        help='combine groups with | (union), & (intersection) and - '
+        '(difference, surrounded by spaces); e.g., "atlanta - testbed"')
+    parser_define_group.set_defaults(handler=subcommands.define_group)
+
     parser_delete_group = subparsers.add_parser(
         'delete', help='delete a group of nodes')
     parser_delete_group.add_argument(
@@ -46,7 +86,10 @@ def create_groups_subcommands(subparsers):
     parser_add_to_group.add_argument(
         'group', type=str, action='store', help='name of the group')
     parser_add_to_group.add_argument(
-        'node', nargs='+', type=str, action='store', help='nodes to add')
+        'node', nargs='*', type=str, action='store', help='nodes to add')
+    parser_add_to_group.add_argument(
+        '-f', '--file', type=str, default=None, action='store',
+        help='also add nodes listed in this file, one per line ("-" for stdin)')
     parser_add_to_group.set_defaults(handler=subcommands.add_to_group)
 
     parser_remove_from_group = subparsers.add_parser(
@@ -54,10 +97,33 @@ def create_groups_subcommands(subparsers):
     parser_remove_from_group.add_argument(
         'group', type=str, action='store', help='name of the group')
     parser_remove_from_group.add_argument(
-        'node', nargs='+', type=str, action='store', help='nodes to remove')
+        'node', nargs='*', type=str, action='store', help='nodes to remove')
+    parser_remove_from_group.add_argument(
+        '-f', '--file', type=str, default=None, action='store',
+        help='also remove nodes listed in this file, one per line ("-" for '
+        'stdin)')
     parser_remove_from_group.set_defaults(
         handler=subcommands.remove_from_group)
 
+    parser_import_to_group = subparsers.add_parser(
+        'import', help='update a group from a list of nodes')
+    parser_import_to_group.add_argument(
+        'group', type=str, action='store', help='name of the group')
+    parser_import_to_group.add_argument(
+        'filename', type=str, nargs='?', default='-', action='store',
+        help='file listing nodes, one per line (default: standard input)')
+    parser_import_to_group.add_argument(
+        '--mode', type=str, default='add',
+        choices=['add', 'remove', 'replace', 'intersect'], action='store',
+        help='add the listed nodes, remove them, make the group exactly the '
+        'listed nodes, or keep only group members that are listed '
+        '(default: add)')
+    parser_import_to_group.add_argument(
+        '--with-group', dest='with_group', type=str, default=None,
+        action='store', metavar='GROUP',
+        help='ignore listed nodes that are not in GROUP')
+    parser_import_to_group.set_defaults(handler=subcommands.import_to_group)
+
 
 def create_experiments_subcommands(subparsers):
     parser_new_experiment = subparsers.add_parser(
@@ -238,6 +304,33 @@ def create_packages_subcommands(subparsers):
     parser_add_extra_package.set_defaults(
         handler=subcommands.add_extra_package)
 
+    parser_query_packages = subparsers.add_parser(
+        'query', help='find every place matching packages are used')
+    parser_query_packages.add_argument(
+        'name', type=str, nargs='?', action='store',
+        help='name of the package')
+    parser_query_packages.add_argument(
+        '--version', type=str, action='store', help='version of the package')
+    parser_query_packages.add_argument(
+        '--architecture', type=str, action='store',
+        help='target architecture (e.g., ar71xx)')
+    parser_query_packages.add_argument(
+        '--sha1', type=str, action='store',
+        help='SHA1 of the ipk, or a prefix of it')
+    parser_query_packages.add_argument(
+        '--release', type=str, action='store', help='only in this release')
+    parser_query_packages.add_argument(
+        '--experiment', type=str, action='store',
+        help='only in this experiment')
+    parser_query_packages.add_argument(
+        '--group', type=str, action='store',
+        help='only upgrades and experiment packages for this group')
+    parser_query_packages.add_argument(
+        '--usage', type=str, action='store',
+        choices=['imported', 'builtin', 'extra', 'upgrade', 'experiment'],
+        help='only this kind of use')
+    parser_query_packages.set_defaults(handler=subcommands.query_packages)
+
     parser_upgrade_package = subparsers.add_parser(
         'upgrade', help='upgrade a builtin package on a set of routers')
     parser_upgrade_package.add_argument(
@@ -265,6 +358,33 @@ def create_releases_subcommands(subparsers):
     parser_list_architectures.set_defaults(
         handler=subcommands.list_architectures)
 
+    parser_clone_release = subparsers.add_parser(
+        'clone', help='create a new release from an existing one')
+    parser_clone_release.add_argument(
+        'source', type=str, action='store',
+        help='release to clone (e.g., lancre-rc1)')
+    parser_clone_release.add_argument(
+        'name', type=str, action='store',
+        help='name of the new release (e.g., lancre-rc2)')
+    parser_clone_release.add_argument(
+        '--build-root', dest='buildroot', type=str, default=None,
+        action='store',
+        help='take architectures, images and packages from this compiled '
+        'OpenWRT buildroot, importing only files that differ from the '
+        'source release')
+    parser_clone_release.set_defaults(handler=subcommands.clone_release)
+
+    parser_diff_releases = subparsers.add_parser(
+        'diff', help='show packages, images and upgrades that differ between '
+        'two releases')
+    parser_diff_releases.add_argument(
+        'old_release', type=str, action='store',
+        help='release to compare from (e.g., lancre-rc1)')
+    parser_diff_releases.add_argument(
+        'new_release', type=str, action='store',
+        help='release to compare to (e.g., lancre-rc2)')
+    parser_diff_releases.set_defaults(handler=subcommands.diff_releases)
+
     parser_new_release = subparsers.add_parser(
         'new', help='create a new release')
     parser_new_release.add_argument(
@@ -274,9 +394,105 @@ def create_releases_subcommands(subparsers):
     parser_new_release.set_defaults(handler=subcommands.new_release)
 
 
-def main():
-    parser = argparse.ArgumentParser(
-        description='Publish releases of BISmark images, packages, and experiments')
+def create_nodes_subcommands(subparsers):
+    parser_show_node = subparsers.add_parser(
+        'show', help='show the packages and experiments a node gets')
+    parser_show_node.add_argument(
+        'node', type=str, action='store', help='name of the node')
+    parser_show_node.add_argument(
+        '--release', type=str, action='store', default=None,
+        help='only show this release (e.g., quirm)')
+    parser_show_node.set_defaults(handler=subcommands.show_node)
+
+
+def _deploy_options_parser(subcommand=False):
+    # Shared by "deploy" and its subcommands, so options can go before or after
+    # the subcommand. Python 2.7's argparse lets a subcommand's defaults
+    # overwrite options given before it, so the subcommands' copies have none.
+    def default(value):
+        if subcommand:
+            return argparse.SUPPRESS
+        return value
+
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument(
+        '-d', '--destination', type=str,
+        default=default('bismark-downloads.noise.gatech.edu:/var/www/downloads.projectbismark.net'),
+        action='store', help='deploy to this directory')
+    parser.add_argument(
+        '-k', '--signingkey', type=str,
+        default=default('~/.bismark_signing_key.pem'),
+        action='store', help='sign Packages.gz with this key')
+    parser.add_argument(
+        '--compare', type=str, choices=['checksum', 'mtime'],
+        default=default('checksum'), action='store',
+        help='how rsync detects changed files; "mtime" compares sizes and '
+        'modification times instead of reading every file')
+    parser.add_argument(
+        '-j', '--jobs', type=int, default=default(1), action='store',
+        help='copy to the destination using this many concurrent rsync '
+        'streams, one per release or subtree')
+    parser.add_argument(
+        '--atomic', action='store_true', default=default(False),
+        help='publish into a new versioned directory under a local '
+        'destination, hardlinking unchanged files from the previous version, '
+        'then atomically repoint DESTINATION/current at it')
+    parser.add_argument(
+        '--keep-versions', dest='keep_versions', type=_positive_integer,
+        default=default(3), action='store',
+        help='with --atomic, keep this many published versions, including '
+        'the current one')
+    parser.add_argument(
+        '--keep-snapshots', dest='keep_snapshots', type=_positive_integer,
+        default=default(5), action='store', help='keep this many hardlinked snapshots of past '
+        'deployments for rollback')
+    parser.add_argument(
+        '--metrics', type=str, default=default(None), action='store',
+        metavar='FILE',
+        help='write per-phase timings and counters to FILE as JSON')
+    parser.add_argument(
+        '--profile', type=str, default=default(None), action='store',
+        metavar='FILE',
+        help='write cProfile statistics to FILE (read them with pstats)')
+    return parser
+
+
+def create_deploy_subcommands(subparsers):
+    deploy_options = _deploy_options_parser(subcommand=True)
+    parser_publish = subparsers.add_parser(
+        'publish', help='stage and publish all releases (the default)',
+        parents=[deploy_options])
+    parser_publish.set_defaults(action='publish')
+
+    parser_rollback = subparsers.add_parser(
+        'rollback', help='republish a past deployment snapshot',
+        parents=[deploy_options])
+    parser_rollback.add_argument(
+        'snapshot', type=str, nargs='?', action='store',
+        help='snapshot to roll back to (default: the one before the latest)')
+    parser_rollback.set_defaults(action='rollback')
+
+    parser_snapshots = subparsers.add_parser(
+        'snapshots', help='list past deployment snapshots')
+    parser_snapshots.set_defaults(action='snapshots')
+
+
+def _default_deploy_subcommand(argv):
+    # Python 2's argparse requires a subcommand once a parser has any, but a
+    # plain "brm deploy" still publishes. Only the command itself counts, not
+    # option values or arguments that happen to be "deploy".
+    _, rest = _global_options_parser().parse_known_args(argv)
+    if not rest or rest[0] != 'deploy':
+        return argv
+    _, rest = _deploy_options_parser().parse_known_args(rest[1:])
+    for argument in rest:
+        if argument in ['-h', '--help'] or not argument.startswith('-'):
+            return argv
+    return argv + ['publish']
+
+
+def _global_options_parser():
+    parser = argparse.ArgumentParser(add_help=False)
     parser.add_argument('--root', dest='root', action='store',
                         default='~/bismark-releases', help='store release configuration in this directory')
     log_levels = ['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITITCAL']
@@ -284,6 +500,20 @@ def main():
                         choices=log_levels, default='WARNING', help='control verbosity of logging')
     parser.add_argument('--logfile', dest='logfile', action='store',
                         default=None, help='append logs to this file')
+    parser.add_argument('--format', dest='format', action='store',
+                        choices=['columns', 'json', 'jsonl', 'tsv'],
+                        default='columns',
+                        help='print listings as aligned columns, a JSON array, '
+                        'one JSON object per line, or tab-separated values '
+                        'with a header; all but columns are written as they '
+                        'are produced')
+    return parser
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(
+        description='Publish releases of BISmark images, packages, and experiments',
+        parents=[_global_options_parser()])
     subparsers = parser.add_subparsers(title='commands')
 
     parser_groups = subparsers.add_parser(
@@ -307,6 +537,10 @@ def main():
         title='releases subcommands')
     create_releases_subcommands(releases_subparsers)
 
+    parser_nodes = subparsers.add_parser('nodes', help='Inspect nodes')
+    nodes_subparsers = parser_nodes.add_subparsers(title='nodes subcommands')
+    create_nodes_subcommands(nodes_subparsers)
+
     parser_commit = subparsers.add_parser(
         'commit', help='commit current release configuration to git')
     parser_commit.set_defaults(handler=subcommands.commit)
@@ -317,28 +551,64 @@ def main():
 
     parser_deploy = subparsers.add_parser('deploy',
                                           help='deploy all releases',
+                                          parents=[_deploy_options_parser()],
                                           formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-    parser_deploy.add_argument(
-        '-d', '--destination', type=str,
-        default='bismark-downloads.noise.gatech.edu:/var/www/downloads.projectbismark.net',
-        action='store', help='deploy to this directory')
-    parser_deploy.add_argument(
-        '-k', '--signingkey', type=str,
-        default='~/.bismark_signing_key.pem',
-        action='store', help='sign Packages.gz with this key')
     parser_deploy.set_defaults(handler=subcommands.deploy)
+    deploy_subparsers = parser_deploy.add_subparsers(
+        title='deploy subcommands')
+    create_deploy_subcommands(deploy_subparsers)
 
     parser_deploy = subparsers.add_parser(
         'check', help='check validity of the release configuration')
     parser_deploy.set_defaults(handler=subcommands.check)
 
-    args = parser.parse_args()
+    parser_verify = subparsers.add_parser(
+        'verify', help='check package and image fingerprints in parallel')
+    parser_verify.add_argument(
+        '--release', type=str, action='append', default=None,
+        help='only verify this release; repeat for several releases')
+    parser_verify.add_argument(
+        '--sample', type=_percentage, default=None, action='store',
+        metavar='N%', help='only verify a random N%% of the files')
+    parser_verify.add_argument(
+        '--resume', action='store_true', default=False,
+        help='skip files that an interrupted run already verified')
+    parser_verify.add_argument(
+        '-j', '--jobs', type=int, default=None,
+        action='store', help='number of files to verify concurrently '
+        '(default: number of CPUs)')
+    parser_verify.set_defaults(handler=subcommands.verify)
+
+    parser_gc = subparsers.add_parser(
+        'gc', help='remove packages and images that nothing references')
+    parser_gc.add_argument(
+        '--dry-run', dest='dry_run', action='store_true', default=False,
+        help='only report what would be removed')
+    parser_gc.set_defaults(handler=subcommands.collect_garbage)
+
+    parser_batch = subparsers.add_parser(
+        'batch', help='run many commands and save their changes once')
+    parser_batch.add_argument(
+        'filename', type=str, nargs='?', default='-', action='store',
+        help='read commands from this file, one per line, in the same syntax '
+        'as the command line (default: standard input)')
+    parser_batch.set_defaults(handler=subcommands.batch, parser=parser)
+
+    return parser
+
+
+def main():
+    parser = create_parser()
+    args = parser.parse_args(_default_deploy_subcommand(sys.argv[1:]))
 
     logging.basicConfig(format='%(asctime)s %(message)s',
                         datefmt='%m/%d/%Y %I:%M:%S %p',
                         filename=args.logfile,
                         level=getattr(logging, args.loglevel))
 
+    # Import the tree only after parsing arguments, so --help and argument
+    # errors don't pay for it.
+    import tree
     releases_tree = tree.BismarkReleasesTree(os.path.expanduser(args.root))
     args.handler(releases_tree, args)
 
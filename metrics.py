@@ -0,0 +1,49 @@
+from collections import defaultdict, OrderedDict
+import contextlib
+import json
+import logging
+import time
+
+_phases = OrderedDict()
+_counters = defaultdict(int)
+
+
+def reset():
+    _phases.clear()
+    _counters.clear()
+
+
+@contextlib.contextmanager
+def phase(name):
+    start = time.time()
+    try:
+        yield
+    finally:
+        elapsed = time.time() - start
+        if name not in _phases:
+            _phases[name] = {'calls': 0, 'seconds': 0.0}
+        _phases[name]['calls'] += 1
+        _phases[name]['seconds'] += elapsed
+        logging.info('Phase %r took %.3f seconds', name, elapsed)
+
+
+def increment(name, amount=1):
+    _counters[name] += amount
+
+
+def report():
+    total = 0.0
+    for phase_metrics in _phases.values():
+        total += phase_metrics['seconds']
+    return OrderedDict([
+        ('phases', _phases),
+        ('counters', OrderedDict(sorted(_counters.items()))),
+        ('total_seconds', total),
+    ])
+
+
+def write_report(filename):
+    logging.info('Writing metrics to %r', filename)
+    with open(filename, 'w') as handle:
+        json.dump(report(), handle, indent=2)
+        print >>handle
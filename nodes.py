@@ -0,0 +1,91 @@
+from collections import namedtuple
+
+import deploy
+
+NodePackage = namedtuple('NodePackage', ['release',
+                                         'architecture',
+                                         'source',
+                                         'name',
+                                         'version',
+                                         'experiment'])
+
+
+class _SingleNodeGroups(object):
+    # Resolves groups like NodeGroups, but keeps only one node and the
+    # "default" pseudo-node. Running deploy's resolution and normalization
+    # through this gives exactly what deploy would give that node, without
+    # expanding every group in the deployment.
+
+    def __init__(self, node_groups, node):
+        self._node_groups = node_groups
+        self._nodes = frozenset([node, 'default'])
+
+    def resolve_to_nodes(self, group_or_node):
+        return self._node_groups.resolve_to_nodes(group_or_node) & self._nodes
+
+
+def _packages_for_node(node_packages, node):
+    # Nodes without a directory of their own get the default directory.
+    packages = set()
+    for node_package in node_packages:
+        if node_package.node == node:
+            packages.add(node_package)
+    if packages:
+        return packages
+    for node_package in node_packages:
+        if node_package.node == 'default':
+            packages.add(node_package)
+    return packages
+
+
+def _architectures(release):
+    return sorted(architecture.name for architecture in release.architectures)
+
+
+def node_packages(release, experiments, node_groups, node):
+    single_node_groups = _SingleNodeGroups(node_groups, node)
+
+    upgraded_versions = dict()
+    upgrades = _packages_for_node(
+        deploy._upgraded_packages(release, single_node_groups), node)
+    for upgrade in upgrades:
+        for architecture in release.normalize_architecture(
+                upgrade.architecture):
+            upgraded_versions[architecture, upgrade.name] = upgrade.version
+
+    for architecture in _architectures(release):
+        for package in sorted(release.builtin_packages):
+            if package.architecture not in [architecture, 'all']:
+                continue
+            key = architecture, package.name
+            if key in upgraded_versions:
+                yield NodePackage(release.name, architecture, 'upgrade',
+                                  package.name, upgraded_versions[key], '-')
+            else:
+                yield NodePackage(release.name, architecture, 'builtin',
+                                  package.name, package.version, '-')
+
+    bodies = deploy._normalized_configuration_bodies(release,
+                                                     experiments,
+                                                     single_node_groups)
+    if node in bodies:
+        body = bodies[node]
+    else:
+        body = bodies.get('default', {})
+    for (architecture, experiment, name), version in sorted(body.items()):
+        yield NodePackage(release.name, architecture, 'experiment',
+                          name, version, experiment)
+
+
+def experiment_configurations(release, experiments, node_groups, node):
+    single_node_groups = _SingleNodeGroups(node_groups, node)
+    configurations = deploy._experiment_configurations(release,
+                                                       experiments,
+                                                       single_node_groups)
+    for architecture in _architectures(release):
+        if (architecture, node) in configurations:
+            configuration = configurations[architecture, node]
+        else:
+            configuration = configurations.get((architecture, 'default'), {})
+        yield architecture, ''.join(
+            configuration[name] + '\n' for name in sorted(configuration))
@@ -1,9 +1,62 @@
-import glob
+from collections import namedtuple
 import logging
 import os
+import stat
 
 import opkg
 
+# scandir (built into Python 3.5 as os.scandir) reports whether each entry is
+# a directory without another stat call, which matters for build trees on
+# NFS. Without it, every entry is stat'ed.
+try:
+    from scandir import scandir
+except ImportError:
+    scandir = None
+
+FileStat = namedtuple('FileStat', ['size', 'mtime'])
+
+
+def _list_directory(path):
+    # Yields (name, path, file_stat) for each entry in path, skipping hidden
+    # entries like glob does. file_stat is None for directories; entries that
+    # are neither directories nor regular files are skipped.
+    try:
+        if scandir is not None:
+            entries = sorted(scandir(path), key=lambda entry: entry.name)
+        else:
+            entries = sorted(os.listdir(path))
+    except OSError:
+        return
+    for entry in entries:
+        if scandir is not None:
+            name = entry.name
+            entry_path = entry.path
+        else:
+            name = entry
+            entry_path = os.path.join(path, name)
+        if name.startswith('.'):
+            continue
+        try:
+            if scandir is not None:
+                if entry.is_dir():
+                    yield name, entry_path, None
+                    continue
+                if not entry.is_file():
+                    continue
+                entry_stat = entry.stat()
+            else:
+                entry_stat = os.stat(entry_path)
+                if stat.S_ISDIR(entry_stat.st_mode):
+                    yield name, entry_path, None
+                    continue
+                if not stat.S_ISREG(entry_stat.st_mode):
+                    continue
+        except OSError:
+            logging.info('Skipping "%s"', entry_path)
+            continue
+        yield name, entry_path, FileStat(entry_stat.st_size,
+                                         entry_stat.st_mtime)
+
 
 class BuildTree(object):
 
@@ -17,56 +70,93 @@ class BuildTree(object):
         if not os.path.isdir(os.path.join(build_root, 'build_dir')):
             raise Exception('OpenWrt build mssing build_dir/')
         self._build_root = build_root
+        self._indexed = False
+        self._builtin_packages = None
 
-    def architectures(self):
-        architectures = set()
-        pattern = os.path.join(self._build_root, 'bin', '*')
-        logging.info('Getting architectures from "%s"', pattern)
-        for filename in glob.iglob(pattern):
-            architecture = os.path.basename(filename)
-            if not os.path.isdir(filename):
+    def _index(self):
+        # Walks bin/ and build_dir/ once, recording everything the other
+        # methods need, so importing a build never lists a directory twice.
+        if self._indexed:
+            return
+        logging.info('Indexing OpenWrt build tree "%s"', self._build_root)
+        self._architectures = set()
+        self._images = set()
+        self._package_directories = set()
+        self._package_files = []
+        self._control_files = []
+        self._file_stats = dict()
+
+        for architecture, architecture_path, file_stat in _list_directory(
+                os.path.join(self._build_root, 'bin')):
+            if file_stat is not None:
                 logging.info('"%s" is not an architecture', architecture)
                 continue
             logging.info('Adding architecture "%s"', architecture)
-            architectures.add(architecture)
-        return architectures
+            self._architectures.add(architecture)
+            for name, path, file_stat in _list_directory(architecture_path):
+                if file_stat is not None:
+                    logging.info('Adding image "%s"', path)
+                    self._images.add((path, architecture))
+                    self._file_stats[path] = file_stat
+                    continue
+                if name != 'packages':
+                    continue
+                logging.info('Adding package directory "%s"', path)
+                self._package_directories.add(path)
+                for name, package_path, file_stat in _list_directory(path):
+                    if file_stat is None or not name.endswith('.ipk'):
+                        continue
+                    self._package_files.append(package_path)
+                    self._file_stats[package_path] = file_stat
 
-    def images(self):
-        images = set()
-        pattern = os.path.join(self._build_root, 'bin', '*', '*')
-        logging.info('Getting images from "%s"', pattern)
-        for filename in glob.iglob(pattern):
-            if not os.path.isfile(filename):
-                logging.info('"%s" is not an image', filename)
+        for target, target_path, file_stat in _list_directory(
+                os.path.join(self._build_root, 'build_dir')):
+            if file_stat is not None or not target.startswith('target-'):
                 continue
-            logging.info('Adding image "%s"', filename)
-            architecture = os.path.basename(os.path.dirname(filename))
-            images.add((filename, architecture))
-        return images
+            for root, root_path, file_stat in _list_directory(target_path):
+                if file_stat is not None or not root.startswith('root-'):
+                    continue
+                info_path = os.path.join(
+                    root_path, 'usr', 'lib', 'opkg', 'info')
+                for name, path, file_stat in _list_directory(info_path):
+                    if file_stat is None or not name.endswith('.control'):
+                        continue
+                    self._control_files.append(path)
+                    self._file_stats[path] = file_stat
+        self._indexed = True
+
+    def architectures(self):
+        self._index()
+        return set(self._architectures)
+
+    def images(self):
+        self._index()
+        return set(self._images)
 
     def builtin_packages(self):
-        packages = set()
-        pattern = os.path.join(
-            self._build_root, 'build_dir', 'target-*', 'root-*',
-            'usr', 'lib', 'opkg', 'info', '*.control')
-        logging.info('Getting builtin packages from "%s"', pattern)
-        for filename in glob.iglob(pattern):
-            package = opkg.parse_control_file(filename)
-            if package is None:
-                logging.warning('Skipping %s', filename)
-                continue
-            logging.info('Adding builtin package "%s"', filename)
-            packages.add(package)
-        return packages
+        if self._builtin_packages is None:
+            self._index()
+            self._builtin_packages = set()
+            for filename in self._control_files:
+                package = opkg.parse_control_file(filename)
+                if package is None:
+                    logging.warning('Skipping %s', filename)
+                    continue
+                logging.info('Adding builtin package "%s"', filename)
+                self._builtin_packages.add(package)
+        return set(self._builtin_packages)
 
     def package_directories(self):
-        directories = set()
-        pattern = os.path.join(self._build_root, 'bin', '*', 'packages')
-        logging.info('Getting package directories from "%s"', pattern)
-        for path in glob.iglob(pattern):
-            if not os.path.isdir(path):
-                logging.info('"%s" is not a package directory', path)
-                continue
-            logging.info('Adding package directory "%s"', path)
-            directories.add(path)
-        return directories
+        self._index()
+        return set(self._package_directories)
+
+    def package_files(self):
+        # Every .ipk in every package directory.
+        self._index()
+        return list(self._package_files)
+
+    def file_stat(self, path):
+        # Size and modification time of an image, package or control file,
+        # as of when the tree was indexed.
+        self._index()
+        return self._file_stats[path]
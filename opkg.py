@@ -1,6 +1,9 @@
+from collections import OrderedDict
 import logging
 import os
 import re
+import StringIO
+import struct
 import tarfile
 
 import common
@@ -20,30 +23,110 @@ def parse_control_file(filename):
     return parse_package_from_control_contents(contents)
 
 
+def parse_ipks(filenames):
+    # Returns {filename: Package, or None if it can't be parsed}.
+    packages = dict()
+    for filename, contents in read_control_files_from_ipks(filenames):
+        packages[filename] = parse_package_from_control_contents(contents)
+    return packages
+
+
 def generate_package_index(filename):
-    logging.info('Generating package index for %r', filename)
-    contents = read_control_file_from_ipk(filename)
+    return generate_package_indexes([filename])[0]
 
-    basename = os.path.basename(filename)
-    stat = os.stat(filename)
-    file_size = stat.st_size
-    md5sum = common.md5sum(filename)
 
+def generate_package_indexes(filenames):
+    # Deployments hardlink the same package into many directories, so each
+    # distinct file is only read and checksummed once.
+    logging.info('Generating package indexes for %d files', len(filenames))
     regex = re.compile(r'^Description:', re.MULTILINE)
-    replacement = 'Filename: %s\n' \
-                  'Size: %d\n' \
-                  'MD5Sum: %s\n' \
-                  'Description:' % (basename, file_size, md5sum)
-    return regex.sub(replacement, contents, count=1)
+    md5sums = dict()
+    indexes = []
+    for filename, contents in read_control_files_from_ipks(filenames):
+        stat = os.stat(filename)
+        key = stat.st_dev, stat.st_ino
+        if key not in md5sums:
+            md5sums[key] = common.md5sum(filename)
+        replacement = 'Filename: %s\n' \
+                      'Size: %d\n' \
+                      'MD5Sum: %s\n' \
+                      'Description:' % (os.path.basename(filename),
+                                        stat.st_size,
+                                        md5sums[key])
+        indexes.append(regex.sub(replacement, contents, count=1))
+    return indexes
+
+
+def read_control_files_from_ipks(filenames):
+    # Yields (filename, control file contents) for each of filenames, reading
+    # hardlinked copies of the same file only once.
+    contents_by_inode = dict()
+    for filename in filenames:
+        stat = os.stat(filename)
+        key = stat.st_dev, stat.st_ino
+        if key not in contents_by_inode:
+            contents_by_inode[key] = read_control_file_from_ipk(filename)
+        yield filename, contents_by_inode[key]
+
+
+_AR_MAGIC = '!<arch>\n'
+_AR_HEADER = struct.Struct('16s12s6s6s8s10s2s')
+
+
+def _member_name(name):
+    name = name.strip()
+    if name.endswith('/'):
+        name = name[:-1]
+    if name.startswith('./'):
+        name = name[2:]
+    return name
+
+
+def _read_ar_member(handle, member_name):
+    # ar archives are a sequence of headers and contents, so members before
+    # the one we want are skipped without reading them.
+    while True:
+        header = handle.read(_AR_HEADER.size)
+        if len(header) < _AR_HEADER.size:
+            return None
+        name, _, _, _, _, size, magic = _AR_HEADER.unpack(header)
+        if magic != '`\n':
+            raise Exception('Corrupt ar header in ipk')
+        size = int(size)
+        if _member_name(name) == member_name:
+            return handle.read(size)
+        handle.seek(size + size % 2, os.SEEK_CUR)
+
+
+def _read_tar_member(fileobj, member_name):
+    # Reads the archive as a stream and stops as soon as the member has been
+    # read, so nothing after it is decompressed.
+    tar_handle = tarfile.open(fileobj=fileobj, mode='r|*')
+    try:
+        for member in tar_handle:
+            if _member_name(member.name) == member_name and member.isfile():
+                return tar_handle.extractfile(member).read()
+    finally:
+        tar_handle.close()
+    return None
 
 
 def read_control_file_from_ipk(filename):
-    logging.info('Parsing ipk %r', filename)
-    tar_handle = tarfile.open(filename, 'r:gz')
-    control_tar_file = tar_handle.extractfile('./control.tar.gz')
-    control_tar_handle = tarfile.open(fileobj=control_tar_file)
-    control_file = control_tar_handle.extractfile('./control')
-    return control_file.read()
+    # ipks are either a gzipped tar or an ar archive containing
+    # debian-binary, data.tar.gz and control.tar.gz, in any order.
+    logging.info('Reading control file from ipk %r', filename)
+    with open(filename, 'rb') as handle:
+        if handle.read(len(_AR_MAGIC)) == _AR_MAGIC:
+            control_tar = _read_ar_member(handle, 'control.tar.gz')
+        else:
+            handle.seek(0)
+            control_tar = _read_tar_member(handle, 'control.tar.gz')
+    if control_tar is None:
+        raise Exception('Missing control.tar.gz in %s' % filename)
+    control = _read_tar_member(StringIO.StringIO(control_tar), 'control')
+    if control is None:
+        raise Exception('Missing control file in %s' % filename)
+    return control
 
 
 def parse_package_from_control_contents(contents):
@@ -67,9 +150,137 @@ def parse_package_from_control_contents(contents):
     return release.Package(name=name, version=version, architecture=architecture)
 
 
-def fingerprint_package(filename):
+def parse_control_fields(contents):
+    # Returns every field of a control file, in order. Continuation lines
+    # (which start with whitespace) are joined to their field with newlines.
+    fields = OrderedDict()
+    key = None
+    for line in contents.splitlines():
+        if not line.strip():
+            continue
+        if line[0] in ' \t':
+            if key is not None:
+                fields[key] += '\n' + line.strip()
+            continue
+        key, colon, value = line.partition(':')
+        if not colon:
+            key = None
+            continue
+        key = key.strip()
+        fields[key] = value.strip()
+    return fields
+
+
+_relationship_pattern = re.compile(
+    r'^(?P<name>[^\s(]+)\s*(?:\(\s*(?P<relation><<|<=|=|>=|>>|<|>)\s*'
+    r'(?P<version>[^\s)]+)\s*\))?$')
+
+
+def parse_relationships(value):
+    # Parses a Depends, Conflicts or Provides value like
+    # "libc, libpcap (>= 1.1), ca-certificates | openssl-util" into a list of
+    # alternatives, each a list of (name, relation, version) tuples. relation
+    # and version are None when the version doesn't matter.
+    relationships = []
+    for clause in value.split(','):
+        if not clause.strip():
+            continue
+        alternatives = []
+        for alternative in clause.split('|'):
+            match = _relationship_pattern.match(alternative.strip())
+            if match is None:
+                raise Exception('Invalid package relationship %r' %
+                                alternative.strip())
+            alternatives.append((match.group('name'),
+                                 match.group('relation'),
+                                 match.group('version')))
+        relationships.append(alternatives)
+    return relationships
+
+
+def version_satisfies(version, relation, required_version):
+    # opkg treats the deprecated < and > like <= and >=.
+    comparison = compare_versions(version, required_version)
+    if relation == '<<':
+        return comparison < 0
+    if relation in ['<=', '<']:
+        return comparison <= 0
+    if relation == '=':
+        return comparison == 0
+    if relation in ['>=', '>']:
+        return comparison >= 0
+    if relation == '>>':
+        return comparison > 0
+    raise Exception('Invalid version relation %r' % relation)
+
+
+# Versions are compared the way opkg (and dpkg) compare them: by epoch, then
+# upstream version, then revision. Within the upstream version and revision,
+# alternating runs of non-digits and digits are compared in turn; digits
+# compare numerically and other characters compare so that '~' sorts before
+# everything (even the end of the string) and letters sort before other
+# symbols. Sort keys are flat tuples of integers that encode those rules so
+# Python's built-in comparison gives the same answer; they're cached because
+# each version is compared many times when sorting or resolving upgrades.
+_version_keys = {}
+
+
+def _character_order(character):
+    if character == '~':
+        return -1
+    if character.isalpha():
+        return ord(character)
+    return ord(character) + 256
+
+
+def _revision_key(text):
+    # Each run of non-digits ends with 0, which is how the end of a run
+    # compares against characters in a longer run, and is followed by its
+    # number. Only the first run can be empty, so the trailing (0, 0)
+    # compares like the end of the string.
+    key = []
+    for non_digits, digits in re.findall(r'(\D*)(\d*)', text):
+        if key and not non_digits and not digits:
+            continue
+        key.extend(_character_order(c) for c in non_digits)
+        key.append(0)
+        key.append(int(digits or 0))
+    key.append(0)
+    key.append(0)
+    return key
+
+
+def version_key(version):
+    try:
+        return _version_keys[version]
+    except KeyError:
+        pass
+    epoch, colon, rest = version.partition(':')
+    if not colon:
+        epoch, rest = '0', version
+    if not epoch.isdigit():
+        raise Exception('Invalid epoch in package version %r' % version)
+    upstream, hyphen, revision = rest.rpartition('-')
+    if not hyphen:
+        upstream, revision = rest, ''
+    key = tuple([int(epoch)] +
+                _revision_key(upstream) +
+                _revision_key(revision))
+    _version_keys[version] = key
+    return key
+
+
+def compare_versions(first, second):
+    return cmp(version_key(first), version_key(second))
+
+
+def fingerprint_package(filename, contents=None):
+    # contents is the package's control file, if the caller has already read
+    # it.
     logging.info('Fingerprinting package %r', filename)
-    package = parse_ipk(filename)
+    if contents is None:
+        contents = read_control_file_from_ipk(filename)
+    package = parse_package_from_control_contents(contents)
     if package is None:
         return None
     sha1 = common.get_fingerprint(filename)
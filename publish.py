@@ -0,0 +1,101 @@
+import glob
+import logging
+import os
+import re
+import shutil
+import time
+
+import common
+
+_CURRENT_LINK = 'current'
+_VERSION_PREFIX = 'deploy-'
+
+
+def is_local_destination(destination):
+    return re.match(r'^[^/]*:', destination) is None
+
+
+def current_version_path(destination):
+    current = os.path.join(destination, _CURRENT_LINK)
+    if not os.path.islink(current):
+        return None
+    return os.path.join(destination, os.readlink(current))
+
+
+def _version_key(name):
+    # Versions published within the same second get a ".N" suffix, which
+    # must compare as a number so ".10" comes after ".2".
+    base, _, suffix = name.partition('.')
+    if suffix.isdigit():
+        return base, int(suffix)
+    return base, 0
+
+
+def versions(destination):
+    # Oldest first.
+    pattern = os.path.join(destination, '%s*' % _VERSION_PREFIX)
+    names = []
+    for path in glob.iglob(pattern):
+        if os.path.isdir(path) and not os.path.islink(path):
+            names.append(os.path.basename(path))
+    return sorted(names, key=_version_key)
+
+
+def _new_version_name(destination):
+    base = '%s%s' % (_VERSION_PREFIX, time.strftime('%Y%m%d-%H%M%S'))
+    name = base
+    suffix = 1
+    while os.path.lexists(os.path.join(destination, name)):
+        name = '%s.%d' % (base, suffix)
+        suffix += 1
+    return name
+
+
+def _flip_current(destination, version_name):
+    current = os.path.join(destination, _CURRENT_LINK)
+    if os.path.lexists(current) and not os.path.islink(current):
+        raise Exception('%r exists and is not a symlink; move it aside '
+                        'before publishing atomically' % current)
+    temporary_link = os.path.join(destination,
+                                  '.%s.%d' % (_CURRENT_LINK, os.getpid()))
+    os.symlink(version_name, temporary_link)
+    # rename(2) replaces the old symlink atomically, so clients always see
+    # either the previous version or the new one, never a mix of both.
+    os.rename(temporary_link, current)
+    logging.info('Pointed %r at %r', current, version_name)
+
+
+def _prune_versions(destination, keep):
+    # Keeps the newest keep versions, including the current one.
+    current = current_version_path(destination)
+    stale = versions(destination)[:-keep]
+    for name in stale:
+        path = os.path.join(destination, name)
+        if current is not None and os.path.samefile(path, current):
+            continue
+        logging.info('Removing old version %r', path)
+        shutil.rmtree(path)
+
+
+def publish(deployment_path, destination, compare='mtime', keep=3):
+    if keep < 1:
+        raise Exception('Must keep at least one version, not %d' % keep)
+    if not is_local_destination(destination):
+        raise Exception('Atomic publishing requires a local destination, '
+                        'not %r' % destination)
+    destination = os.path.abspath(os.path.expanduser(destination))
+    common.makedirs(destination)
+
+    previous = current_version_path(destination)
+    version_name = _new_version_name(destination)
+    version_path = os.path.join(destination, version_name)
+    print 'Publishing %s to %s' % (deployment_path, version_path)
+    bytes_copied = common.link_tree(deployment_path,
+                                    version_path,
+                                    previous,
+                                    compare)
+    print 'Copied %d bytes; linked everything else from %s' % (bytes_copied,
+                                                               previous)
+    _flip_current(destination, version_name)
+    _prune_versions(destination, keep)
+    return version_path
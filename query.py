@@ -0,0 +1,146 @@
+from collections import defaultdict, namedtuple
+import cPickle
+import glob
+import logging
+import os
+
+import common
+
+# Every place a package is referenced: imported into a release, builtin,
+# extra, upgraded for a group, or part of an experiment for a group.
+PackageReference = namedtuple('PackageReference',
+                              ['name',
+                               'version',
+                               'architecture',
+                               'release',
+                               'usage',
+                               'group',
+                               'experiment',
+                               'sha1'])
+
+# Bump this whenever the layout of the cached index changes.
+_CACHE_FORMAT = 1
+
+# The index only depends on these files, so it stays valid until one of them
+# is created, removed or replaced.
+_METADATA_PATTERNS = [
+    'experiments/*/packages',
+    'releases/*/builtin-packages',
+    'releases/*/extra-packages',
+    'releases/*/fingerprinted-packages',
+    'releases/*/package-upgrades',
+]
+
+
+def metadata_signature(root):
+    signature = []
+    for pattern in _METADATA_PATTERNS:
+        for filename in sorted(glob.glob(os.path.join(root, pattern))):
+            stat = os.stat(filename)
+            signature.append((os.path.relpath(filename, root),
+                              stat.st_ino,
+                              stat.st_size,
+                              stat.st_mtime))
+    return tuple(signature)
+
+
+def build_references(releases, experiments):
+    sha1s = dict()
+    for bismark_release in releases:
+        for package in bismark_release.packages:
+            key = (bismark_release.name,
+                   package.name,
+                   package.version,
+                   package.architecture)
+            sha1s[key] = package.sha1
+            yield (package.name, package.version, package.architecture,
+                   bismark_release.name, 'imported', '-', '-', package.sha1)
+
+    for bismark_release in releases:
+        for usage, packages in [('builtin', bismark_release.builtin_packages),
+                                ('extra', bismark_release.extra_packages)]:
+            for package in packages:
+                sha1 = sha1s.get((bismark_release.name,
+                                  package.name,
+                                  package.version,
+                                  package.architecture), '-')
+                yield (package.name, package.version, package.architecture,
+                       bismark_release.name, usage, '-', '-', sha1)
+        for upgrade in bismark_release.package_upgrades:
+            sha1 = sha1s.get((bismark_release.name,
+                              upgrade.name,
+                              upgrade.version,
+                              upgrade.architecture), '-')
+            yield (upgrade.name, upgrade.version, upgrade.architecture,
+                   bismark_release.name, 'upgrade', upgrade.group, '-', sha1)
+
+    for name, experiment in experiments.iteritems():
+        for package in experiment.packages:
+            sha1 = sha1s.get((package.release,
+                              package.name,
+                              package.version,
+                              package.architecture), '-')
+            yield (package.name, package.version, package.architecture,
+                   package.release, 'experiment', package.group, name, sha1)
+
+
+class PackageIndex(object):
+
+    def __init__(self, references):
+        self._by_name = defaultdict(list)
+        for reference in references:
+            self._by_name[reference[0]].append(reference)
+
+    def query(self, name=None, version=None, architecture=None, sha1=None,
+              release=None, experiment=None, group=None, usage=None):
+        if name is not None:
+            candidates = self._by_name.get(name, [])
+        else:
+            candidates = (reference
+                          for references in self._by_name.itervalues()
+                          for reference in references)
+        for reference in candidates:
+            if version is not None and reference[1] != version:
+                continue
+            if architecture is not None and reference[2] != architecture:
+                continue
+            if release is not None and reference[3] != release:
+                continue
+            if usage is not None and reference[4] != usage:
+                continue
+            if group is not None and reference[5] != group:
+                continue
+            if experiment is not None and reference[6] != experiment:
+                continue
+            if sha1 is not None and not reference[7].startswith(sha1):
+                continue
+            yield PackageReference._make(reference)
+
+    def _save(self, filename, signature):
+        logging.info('Caching package index in %r', filename)
+        common.makedirs(os.path.dirname(filename))
+        with common.atomic_write(filename) as handle:
+            cPickle.dump((_CACHE_FORMAT, signature, dict(self._by_name)),
+                         handle,
+                         cPickle.HIGHEST_PROTOCOL)
+
+
+def open_index(root, cache_filename, releases, experiments):
+    # releases and experiments are callables, so nothing is opened when the
+    # cached index is still valid.
+    signature = metadata_signature(root)
+    try:
+        with open(cache_filename, 'rb') as handle:
+            cache_format, cached_signature, by_name = cPickle.load(handle)
+    except (IOError, EOFError, ValueError, cPickle.UnpicklingError):
+        cache_format, cached_signature, by_name = None, None, None
+    if cache_format == _CACHE_FORMAT and cached_signature == signature:
+        logging.info('Using cached package index %r', cache_filename)
+        index = PackageIndex([])
+        index._by_name.update(by_name)
+        return index
+
+    logging.info('Building package index')
+    index = PackageIndex(build_references(releases(), experiments()))
+    index._save(cache_filename, signature)
+    return index
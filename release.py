@@ -1,14 +1,12 @@
-from collections import namedtuple
+from collections import defaultdict, namedtuple
 import glob
 import logging
 import os
 import shutil
 import stat
 import tempfile
-import urllib2
 
 import common
-import opkg
 
 Architecture = namedtuple('Architecture', ['name'])
 PackageDirectory = namedtuple('PackageDirectory', ['name'])
@@ -43,15 +41,100 @@ class GroupPackage(_GroupPackage):
         return Package(self.name, self.version, self.architecture)
 
 
+ReleaseDifference = namedtuple('ReleaseDifference',
+                               ['category',
+                                'architecture',
+                                'name',
+                                'group',
+                                'change',
+                                'old_version',
+                                'new_version'])
+
+
+def _index_packages(packages, sha1s):
+    index = dict()
+    for package in packages:
+        key = ('-', package.name, package.architecture)
+        sha1 = sha1s.get(
+            Package(package.name, package.version, package.architecture))
+        index.setdefault(key, dict())[package.version] = sha1
+    return index
+
+
+def _diff_indexes(category, old_index, new_index):
+    # opkg imports this module, so it's imported where it's used.
+    import opkg
+    for key in sorted(set(old_index) | set(new_index)):
+        old_versions = old_index.get(key, {})
+        new_versions = new_index.get(key, {})
+        if old_versions == new_versions:
+            continue
+        group, name, architecture = key
+        if len(old_versions) == 1 and len(new_versions) == 1:
+            (old_version, _), = old_versions.items()
+            (new_version, _), = new_versions.items()
+            change = 'content' if old_version == new_version else 'version'
+            yield ReleaseDifference(category, architecture, name, group,
+                                    change, old_version, new_version)
+            continue
+        versions = set(old_versions) | set(new_versions)
+        for version in sorted(versions, key=opkg.version_key):
+            if version not in new_versions:
+                yield ReleaseDifference(category, architecture, name, group,
+                                        'removed', version, '-')
+            elif version not in old_versions:
+                yield ReleaseDifference(category, architecture, name, group,
+                                        'added', '-', version)
+            elif old_versions[version] != new_versions[version]:
+                yield ReleaseDifference(category, architecture, name, group,
+                                        'content', version, version)
+
+
+def diff_releases(old_release, new_release):
+    # Entries are keyed by (group, name, architecture) and compared by
+    # version and sha1, so only keys that differ are examined in detail.
+    old_sha1s = dict((p.package, p.sha1) for p in old_release.packages)
+    new_sha1s = dict((p.package, p.sha1) for p in new_release.packages)
+    categories = [
+        ('packages', old_release.packages, new_release.packages),
+        ('builtin', old_release.builtin_packages,
+         new_release.builtin_packages),
+        ('extra', old_release.extra_packages, new_release.extra_packages),
+    ]
+    for category, old_packages, new_packages in categories:
+        for difference in _diff_indexes(
+                category,
+                _index_packages(old_packages, old_sha1s),
+                _index_packages(new_packages, new_sha1s)):
+            yield difference
+
+    old_upgrades, new_upgrades = dict(), dict()
+    for upgrades, sha1s, index in [
+            (old_release.package_upgrades, old_sha1s, old_upgrades),
+            (new_release.package_upgrades, new_sha1s, new_upgrades)]:
+        for upgrade in upgrades:
+            key = (upgrade.group, upgrade.name, upgrade.architecture)
+            index.setdefault(key, dict())[upgrade.version] = sha1s.get(
+                upgrade.package)
+    for difference in _diff_indexes('upgrades', old_upgrades, new_upgrades):
+        yield difference
+
+    old_images, new_images = dict(), dict()
+    for images, index in [(old_release.images, old_images),
+                          (new_release.images, new_images)]:
+        for image in images:
+            index[('-', image.name, image.architecture)] = {'-': image.sha1}
+    for difference in _diff_indexes('images', old_images, new_images):
+        yield difference
+
+
 def new_bismark_release(path, build):
     logging.info('Creating new release in %r', path)
     release = _BismarkRelease(path)
     for name in build.architectures():
         release._architectures.add(Architecture(name))
-    for dirname in build.package_directories():
-        for filename in glob.iglob(os.path.join(dirname, '*.ipk')):
-            release.add_package(filename)
-    release._fingerprint_packages()
+    for filename in build.package_files():
+        release.add_package(filename)
     release._builtin_packages.update(build.builtin_packages())
     for package in release.packages:
         if package.package in release.builtin_packages:
@@ -62,6 +145,112 @@ def new_bismark_release(path, build):
     return release
 
 
+def clone_bismark_release(source, path, build=None):
+    # Package and image blobs are hardlinked from the source release. With a
+    # new build, only files whose fingerprints aren't already in the source
+    # release are copied and parsed. Returns the new release and any upgrades
+    # that were dropped because they're no longer newer than the builtin
+    # package.
+    logging.info('Cloning release %r into %r', source.name, path)
+    release = _BismarkRelease(path)
+    common.makedirs(release._packages_path)
+    for package in source.packages:
+        basename = '%s.ipk' % package.sha1
+        common.link_or_copy(os.path.join(source.packages_path, basename),
+                            os.path.join(release._packages_path, basename))
+        source_control = os.path.join(source._controls_path, package.sha1)
+        if os.path.isfile(source_control):
+            common.makedirs(release._controls_path)
+            common.link_or_copy(source_control,
+                                os.path.join(release._controls_path,
+                                             package.sha1))
+    release._fingerprinted_packages.update(source.packages)
+    release._package_upgrades.update(source.package_upgrades)
+    if build is None:
+        release._architectures.update(source.architectures)
+        release._builtin_packages.update(source.builtin_packages)
+        release._extra_packages.update(source.extra_packages)
+        for image in source.images:
+            release._link_image(source, image)
+        dropped_upgrades = []
+    else:
+        dropped_upgrades = release._import_build(source, build)
+    return release, dropped_upgrades
+
+
+def _format_relationship(relationship):
+    name, relation, version = relationship
+    if relation is None:
+        return name
+    return '%s (%s %s)' % (name, relation, version)
+
+
+class _DependencyGraph(object):
+    # The Depends, Conflicts and Provides of a release's packages. Control
+    # files are only read and parsed for packages whose relationships are
+    # asked for, and Provides only when no package has the wanted name.
+
+    def __init__(self, bismark_release):
+        self._release = bismark_release
+        self._fingerprinted = dict()
+        self._by_name = defaultdict(list)
+        for fingerprinted_package in bismark_release.packages:
+            package = fingerprinted_package.package
+            self._fingerprinted[package] = fingerprinted_package
+            self._by_name[package.name].append(package)
+        self._relationships = dict()
+        self._providers = defaultdict(list)
+        self._indexed_providers = set()
+
+    def relationships(self, package):
+        # Returns {'Depends': ..., 'Conflicts': ..., 'Provides': ...}, as
+        # parsed by opkg.parse_relationships, or None for packages that
+        # weren't imported.
+        if package not in self._relationships:
+            import opkg
+            if package in self._fingerprinted:
+                fields = self._release.control_fields(
+                    self._fingerprinted[package])
+                relationships = dict()
+                for field in ['Depends', 'Conflicts', 'Provides']:
+                    relationships[field] = opkg.parse_relationships(
+                        fields.get(field, ''))
+            else:
+                relationships = None
+            self._relationships[package] = relationships
+        return self._relationships[package]
+
+    def candidates(self, name, available):
+        # Yields (package, version) for each package in available named name,
+        # or else each one that provides it. Provided names have no version.
+        found = False
+        for package in self._by_name.get(name, []):
+            if package in available:
+                found = True
+                yield package, package.version
+        if found:
+            return
+        for package in available:
+            if package in self._indexed_providers:
+                continue
+            self._indexed_providers.add(package)
+            relationships = self.relationships(package)
+            if relationships is None:
+                continue
+            for alternatives in relationships['Provides']:
+                for provided_name, _, _ in alternatives:
+                    self._providers[provided_name].append(package)
+        for package in self._providers[name]:
+            if package in available:
+                yield package, None
+
+
+def _list_directory(path):
+    if not os.path.isdir(path):
+        return []
+    return os.listdir(path)
+
+
 def open_bismark_release(path):
     if not os.path.isdir(path):
         raise Exception('Release does not exist: %s' % path)
@@ -75,6 +264,7 @@ class _BismarkRelease(object):
         self._name = os.path.basename(path)
         self._packages_path = os.path.join(self._path, 'packages')
         self._images_path = os.path.join(self._path, 'images')
+        self._controls_path = os.path.join(self._path, 'controls')
 
         self._architectures = common.NamedTupleSet(
             Architecture,
@@ -94,11 +284,20 @@ class _BismarkRelease(object):
         self._package_upgrades = common.NamedTupleSet(
             GroupPackage,
             self._full_path('package-upgrades'))
+        self._imported_filenames = []
+        self._controls = dict()
+        self._unsaved_controls = set()
+        self._dependency_graph = None
+        self._dependency_graph_packages = None
 
     @property
     def name(self):
         return self._name
 
+    @property
+    def path(self):
+        return self._path
+
     @property
     def builtin_packages(self):
         return self._builtin_packages
@@ -148,9 +347,8 @@ class _BismarkRelease(object):
         return None
 
     def update_base_build(self, build):
-        for dirname in build.package_directories():
-            for filename in glob.iglob(os.path.join(dirname, '*.ipk')):
-                self.add_package(filename)
+        for filename in build.package_files():
+            self.add_package(filename)
         self._fingerprint_packages()
 
     def add_package(self, import_path):
@@ -158,6 +356,8 @@ class _BismarkRelease(object):
             self._add_package_real(import_path)
         else:
             logging.info("%s doesn't exist, so treating it as a URL.", import_path)
+            # urllib2 is slow to import and only needed for URLs.
+            import urllib2
             with tempfile.NamedTemporaryFile(delete=True) as new_file:
                 url_data = urllib2.urlopen(import_path)
                 new_file.write(url_data.read())
@@ -168,12 +368,124 @@ class _BismarkRelease(object):
         common.makedirs(self._packages_path)
         new_basename = '%s.ipk' % common.get_fingerprint(filename)
         new_filename = os.path.join(self._packages_path, new_basename)
+        if not os.path.exists(new_filename):
+            self._imported_filenames.append(new_filename)
         shutil.copy2(filename, new_filename)
         os.chmod(new_filename,
                  stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IROTH)
 
-        fingerprinted_package = opkg.fingerprint_package(new_filename)
-        self._fingerprinted_packages.add(fingerprinted_package)
+        import opkg
+        contents = opkg.read_control_file_from_ipk(new_filename)
+        fingerprinted_package = opkg.fingerprint_package(new_filename,
+                                                         contents)
+        if fingerprinted_package is not None:
+            self._fingerprinted_packages.add(fingerprinted_package)
+            self._controls[fingerprinted_package.sha1] = contents
+            self._unsaved_controls.add(fingerprinted_package.sha1)
+        return fingerprinted_package
+
+    def control_fields(self, fingerprinted_package):
+        # Control files are saved in controls/ when packages are imported.
+        # Packages imported before that are read once and saved with the
+        # release.
+        import opkg
+        sha1 = fingerprinted_package.sha1
+        if sha1 not in self._controls:
+            try:
+                with open(os.path.join(self._controls_path, sha1)) as handle:
+                    self._controls[sha1] = handle.read()
+            except IOError:
+                self._controls[sha1] = opkg.read_control_file_from_ipk(
+                    os.path.join(self._packages_path, '%s.ipk' % sha1))
+                self._unsaved_controls.add(sha1)
+        return opkg.parse_control_fields(self._controls[sha1])
+
+    def dependency_graph(self):
+        packages = frozenset(self._fingerprinted_packages)
+        if self._dependency_graph_packages != packages:
+            self._dependency_graph = _DependencyGraph(self)
+            self._dependency_graph_packages = packages
+        return self._dependency_graph
+
+    def _import_build(self, source, build):
+        known_packages = dict()
+        known_blobs = dict()
+        for fingerprinted_package in self._fingerprinted_packages:
+            known_packages[fingerprinted_package.sha1] = fingerprinted_package
+            known_blobs[fingerprinted_package.package] = fingerprinted_package
+        for name in build.architectures():
+            self._architectures.add(Architecture(name))
+        build_packages = set()
+        imported = 0
+        for filename in build.package_files():
+            sha1 = common.get_fingerprint(filename)
+            if sha1 in known_packages:
+                build_packages.add(known_packages[sha1].package)
+                continue
+            fingerprinted_package = self._add_package_real(filename)
+            if fingerprinted_package is None:
+                logging.warning('Skipping %s, which has no package name, '
+                                'version or architecture', filename)
+                os.remove(os.path.join(self._packages_path, '%s.ipk' % sha1))
+                continue
+            # A rebuild of the same version replaces the old blob.
+            other = known_blobs.get(fingerprinted_package.package)
+            if other is not None:
+                logging.info('Replacing %s with a rebuild', other)
+                self._fingerprinted_packages.discard(other)
+                for old_filename in [
+                        os.path.join(self._packages_path,
+                                     '%s.ipk' % other.sha1),
+                        os.path.join(self._controls_path, other.sha1)]:
+                    if os.path.exists(old_filename):
+                        os.remove(old_filename)
+            build_packages.add(fingerprinted_package.package)
+            imported += 1
+        logging.info('Imported %d new or changed packages', imported)
+        self._builtin_packages.update(build.builtin_packages())
+        # Extra packages added by hand to the source release stay extra.
+        for package in source.extra_packages | build_packages:
+            if package not in self._builtin_packages:
+                self._extra_packages.add(package)
+
+        source_images = dict()
+        for image in source.images:
+            source_images[image.name, image.architecture, image.sha1] = image
+        for path, architecture in build.images():
+            key = (os.path.basename(path),
+                   architecture,
+                   common.get_fingerprint(path))
+            if key in source_images:
+                self._link_image(source, source_images[key])
+            else:
+                self.add_image(path, architecture)
+        return self._drop_invalid_upgrades()
+
+    def _drop_invalid_upgrades(self):
+        # Returns the upgrades that were dropped.
+        import opkg
+        builtin_versions = dict()
+        for package in self._builtin_packages:
+            builtin_versions[(package.name, package.architecture)] = \
+                package.version
+        dropped_upgrades = []
+        for group_package in sorted(self._package_upgrades):
+            key = (group_package.name, group_package.architecture)
+            if (key in builtin_versions and
+                    opkg.version_key(group_package.version) >
+                    opkg.version_key(builtin_versions[key])):
+                continue
+            logging.warning('Dropping upgrade %s, which is no longer newer '
+                            'than a builtin package', group_package)
+            self._package_upgrades.discard(group_package)
+            dropped_upgrades.append(group_package)
+        return dropped_upgrades
+
+    def _link_image(self, source, image):
+        common.makedirs(self._images_path)
+        common.link_or_copy(os.path.join(source.images_path, image.name),
+                            os.path.join(self._images_path, image.name))
+        self._fingerprinted_images.add(image)
 
     def add_image(self, filename, architecture):
         common.makedirs(self._images_path)
@@ -208,10 +520,58 @@ class _BismarkRelease(object):
         group_package = GroupPackage(group, name, version, architecture)
         self._package_upgrades.add(group_package)
 
-    def save(self):
+    def garbage(self, experiment_packages):
+        # Finds imported packages that nothing references, and files in
+        # packages/, controls/ and images/ that no fingerprint refers to.
+        # experiment_packages are the Packages experiments use from this
+        # release.
+        referenced = set(experiment_packages)
+        referenced.update(self._builtin_packages)
+        referenced.update(self._extra_packages)
+        for group_package in self._package_upgrades:
+            referenced.add(group_package.package)
+
+        unreferenced_packages = set()
+        referenced_sha1s = set()
+        for fingerprinted_package in self._fingerprinted_packages:
+            if fingerprinted_package.package in referenced:
+                referenced_sha1s.add(fingerprinted_package.sha1)
+            else:
+                unreferenced_packages.add(fingerprinted_package)
+        unreferenced_filenames = []
+        for basename in sorted(_list_directory(self._packages_path)):
+            sha1, extension = os.path.splitext(basename)
+            if sha1 not in referenced_sha1s or extension != '.ipk':
+                unreferenced_filenames.append(
+                    os.path.join(self._packages_path, basename))
+        for basename in sorted(_list_directory(self._controls_path)):
+            if basename not in referenced_sha1s:
+                unreferenced_filenames.append(
+                    os.path.join(self._controls_path, basename))
+
+        image_names = set(image.name for image in self._fingerprinted_images)
+        for basename in sorted(_list_directory(self._images_path)):
+            if basename not in image_names:
+                unreferenced_filenames.append(
+                    os.path.join(self._images_path, basename))
+        return unreferenced_packages, unreferenced_filenames
+
+    def remove_packages(self, fingerprinted_packages):
+        for fingerprinted_package in fingerprinted_packages:
+            self._fingerprinted_packages.discard(fingerprinted_package)
+
+    def discard_imported_packages(self):
+        for filename in self._imported_filenames:
+            logging.info('Removing imported package %r', filename)
+            os.remove(filename)
+        self._imported_filenames = []
+        self._unsaved_controls = set()
+
+    def save(self, check=True, experiment_packages=()):
         common.makedirs(self._path)
 
-        self.check_constraints()
+        if check:
+            self.check_constraints(experiment_packages)
 
         self._architectures.write_to_file()
         self._builtin_packages.write_to_file()
@@ -219,8 +579,26 @@ class _BismarkRelease(object):
         self._fingerprinted_packages.write_to_file()
         self._fingerprinted_images.write_to_file()
         self._package_upgrades.write_to_file()
-
-    def check_constraints(self):
+        self._write_controls()
+        self._imported_filenames = []
+
+    def _write_controls(self):
+        # Saves control files read from packages imported before controls/
+        # existed, so they're only read from the package once. Checks never
+        # write them; the next save does.
+        if not self._unsaved_controls:
+            return
+        common.makedirs(self._controls_path)
+        for sha1 in sorted(self._unsaved_controls):
+            # Clones hardlink control files, so never write into one.
+            with common.atomic_write(
+                    os.path.join(self._controls_path, sha1)) as handle:
+                handle.write(self._controls[sha1])
+        self._unsaved_controls = set()
+
+    def check_constraints(self, experiment_packages=()):
+        # experiment_packages are the Packages experiments use from this
+        # release, which can satisfy dependencies.
         self._check_builtin_packages_exist()
         self._check_builtin_packages_unique()
         self._check_extra_packages_exist()
@@ -233,11 +611,78 @@ class _BismarkRelease(object):
         self._check_upgrades_valid()
         self._check_upgrades_unique()
         self._check_upgrades_newer()
+        self.check_dependencies(experiment_packages)
+
+    def check_dependencies(self, experiment_packages):
+        # Upgrades and experiment packages must have their Depends satisfied
+        # by builtin, extra, upgraded or experiment packages, since those are
+        # all a router's package feeds offer. Dependencies are followed
+        # transitively, except into builtin packages, which are already
+        # installed.
+        logging.info('checking that package dependencies are satisfied')
+        graph = self.dependency_graph()
+        upgrades = set(group_package.package
+                       for group_package in self._package_upgrades)
+        available = set(self._builtin_packages)
+        available.update(self._extra_packages)
+        available.update(upgrades)
+        available.update(experiment_packages)
+
+        resolved = dict()
+        checked = set()
+        unchecked = sorted(upgrades | set(experiment_packages))
+        while unchecked:
+            package = unchecked.pop()
+            if package in checked:
+                continue
+            checked.add(package)
+            relationships = graph.relationships(package)
+            if relationships is None:
+                continue
+            for alternatives in relationships['Depends']:
+                key = (tuple(alternatives), package.architecture)
+                if key not in resolved:
+                    resolved[key] = self._resolve_dependency(
+                        graph, alternatives, package.architecture, available)
+                dependency = resolved[key]
+                if dependency is None:
+                    raise Exception(
+                        'Package %s %s (%s) depends on %s, which no builtin, '
+                        'extra, upgraded or experiment package in release %r '
+                        'satisfies' % (package.name,
+                                       package.version,
+                                       package.architecture,
+                                       ' | '.join(
+                                           _format_relationship(alternative)
+                                           for alternative in alternatives),
+                                       self._name))
+                if dependency not in self._builtin_packages:
+                    unchecked.append(dependency)
+
+    def _resolve_dependency(self, graph, alternatives, architecture,
+                            available):
+        import opkg
+        for name, relation, version in alternatives:
+            for candidate, candidate_version in sorted(
+                    graph.candidates(name, available)):
+                if (architecture != 'all' and
+                        candidate.architecture not in [architecture, 'all']):
+                    continue
+                if relation is None:
+                    return candidate
+                if candidate_version is None:
+                    continue
+                if opkg.version_satisfies(candidate_version,
+                                          relation,
+                                          version):
+                    return candidate
+        return None
 
     def _full_path(self, basename):
         return os.path.join(self._path, basename)
 
     def _fingerprint_packages(self):
+        import opkg
         logging.info('fingerinting packages in all package directories')
         for filename in glob.iglob(os.path.join(self._packages_path, '*.ipk')):
             fingerprinted_package = opkg.fingerprint_package(filename)
@@ -346,5 +791,19 @@ class _BismarkRelease(object):
                                 (group_package.name, group_package.group))
 
     def _check_upgrades_newer(self):
-        # TODO: Parse and compare versions
-        pass
+        import opkg
+        logging.info('checking that upgrades are newer than builtin packages')
+        builtin_versions = dict()
+        for package in self._builtin_packages:
+            builtin_versions[(package.name, package.architecture)] = \
+                package.version
+        for group_package in self._package_upgrades:
+            key = (group_package.name, group_package.architecture)
+            if key not in builtin_versions:
+                continue
+            builtin_version = builtin_versions[key]
+            if (opkg.version_key(group_package.version) <=
+                    opkg.version_key(builtin_version)):
+                raise Exception(
+                    'upgrade %s is not newer than builtin version %s' % (
+                        group_package, builtin_version))
@@ -13,11 +13,18 @@ setup(
             'experiments',
             'groups',
             'main',
+            'metrics',
+            'nodes',
             'openwrt',
             'opkg',
+            'publish',
+            'query',
             'release',
+            'snapshots',
             'subcommands',
+            'transfer',
             'tree',
+            'verify',
     ],
     entry_points={'console_scripts': ['brm = main:main']},
 )
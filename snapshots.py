@@ -0,0 +1,173 @@
+from collections import namedtuple
+import glob
+import logging
+import os
+import shutil
+import time
+
+import common
+
+ManifestEntry = namedtuple('ManifestEntry',
+                           ['path', 'type', 'size', 'mtime', 'target'])
+SnapshotInfo = namedtuple('SnapshotInfo', ['key', 'value'])
+
+_TREE = 'tree'
+_MANIFEST = 'manifest'
+_INFO = 'info'
+
+
+def _build_manifest(tree_path, manifest):
+    for dirpath, dirnames, filenames in os.walk(tree_path):
+        for name in dirnames + filenames:
+            path = os.path.join(dirpath, name)
+            relative_path = os.path.relpath(path, tree_path)
+            if os.path.islink(path):
+                entry = ManifestEntry(relative_path, 'symlink', '0', '0',
+                                      os.readlink(path))
+            elif os.path.isdir(path):
+                entry = ManifestEntry(relative_path, 'directory', '0', '0', '')
+            else:
+                stat = os.stat(path)
+                entry = ManifestEntry(relative_path,
+                                      'file',
+                                      str(stat.st_size),
+                                      str(int(stat.st_mtime)),
+                                      '')
+            manifest.add(entry)
+
+
+class Snapshot(object):
+
+    def __init__(self, path):
+        self._path = path
+        self._id = os.path.basename(path)
+        self._info = None
+
+    @property
+    def id(self):
+        return self._id
+
+    @property
+    def tree_path(self):
+        return os.path.join(self._path, _TREE)
+
+    @property
+    def manifest(self):
+        return common.NamedTupleSet(ManifestEntry,
+                                    os.path.join(self._path, _MANIFEST))
+
+    @property
+    def info(self):
+        if self._info is None:
+            self._info = {}
+            info = common.NamedTupleSet(SnapshotInfo,
+                                        os.path.join(self._path, _INFO))
+            for record in info:
+                self._info[record.key] = record.value
+        return self._info
+
+    def check_manifest(self):
+        logging.info('Checking snapshot %r against its manifest', self._id)
+        for entry in self.manifest:
+            path = os.path.join(self.tree_path, entry.path)
+            if entry.type == 'symlink':
+                if (not os.path.islink(path) or
+                        os.readlink(path) != entry.target):
+                    raise Exception('Snapshot %s: bad symlink %s' % (
+                        self._id, entry.path))
+            elif entry.type == 'directory':
+                if not os.path.isdir(path):
+                    raise Exception('Snapshot %s: missing directory %s' % (
+                        self._id, entry.path))
+            elif (not os.path.isfile(path) or
+                    os.path.getsize(path) != int(entry.size)):
+                raise Exception('Snapshot %s: missing or modified file %s' % (
+                    self._id, entry.path))
+
+
+def _snapshot_key(snapshot_id):
+    # Snapshots saved within the same second get a ".N" suffix, which must
+    # compare as a number so ".10" comes after ".2".
+    base, _, suffix = snapshot_id.partition('.')
+    if suffix.isdigit():
+        return base, int(suffix)
+    return base, 0
+
+
+class Snapshots(object):
+
+    def __init__(self, root):
+        self._root = root
+
+    def __iter__(self):
+        pattern = os.path.join(self._root, '*')
+        ids = []
+        for path in glob.iglob(pattern):
+            if os.path.isfile(os.path.join(path, _MANIFEST)):
+                ids.append(os.path.basename(path))
+        return iter(sorted(ids, key=_snapshot_key))
+
+    def __getitem__(self, snapshot_id):
+        path = os.path.join(self._root, snapshot_id)
+        if not os.path.isfile(os.path.join(path, _MANIFEST)):
+            raise Exception('Deployment snapshot %r does not exist' % (
+                snapshot_id,))
+        return Snapshot(path)
+
+    def latest(self):
+        ids = list(self)
+        if not ids:
+            return None
+        return self[ids[-1]]
+
+    def previous(self):
+        ids = list(self)
+        if len(ids) < 2:
+            raise Exception('There is no previous deployment to roll back to')
+        return self[ids[-2]]
+
+    def save(self, deployment_path, destination, keep):
+        if keep < 1:
+            raise Exception('Must keep at least one snapshot, not %d' % keep)
+        latest = self.latest()
+        snapshot_id = time.strftime('%Y%m%d-%H%M%S')
+        suffix = 1
+        while os.path.lexists(os.path.join(self._root, snapshot_id)):
+            snapshot_id = '%s.%d' % (time.strftime('%Y%m%d-%H%M%S'), suffix)
+            suffix += 1
+        snapshot_path = os.path.join(self._root, snapshot_id)
+        logging.info('Saving deployment snapshot %r', snapshot_path)
+
+        if latest is None:
+            reference = None
+        else:
+            reference = latest.tree_path
+        tree_path = os.path.join(snapshot_path, _TREE)
+        bytes_copied = common.link_tree(deployment_path, tree_path, reference)
+
+        info = common.NamedTupleSet(SnapshotInfo,
+                                    os.path.join(snapshot_path, _INFO))
+        info.add(SnapshotInfo('created', time.strftime('%Y-%m-%d %H:%M:%S')))
+        info.add(SnapshotInfo('destination', destination))
+        info.write_to_file()
+
+        # The manifest is written last, so a snapshot interrupted while
+        # copying is never listed.
+        manifest = common.NamedTupleSet(ManifestEntry,
+                                        os.path.join(snapshot_path, _MANIFEST))
+        _build_manifest(tree_path, manifest)
+        manifest.write_to_file()
+
+        print 'Saved deployment snapshot %s (%d new bytes)' % (snapshot_id,
+                                                               bytes_copied)
+        self._prune(keep)
+        return self[snapshot_id]
+
+    def _prune(self, keep):
+        ids = list(self)
+        if len(ids) <= keep:
+            return
+        for snapshot_id in ids[:-keep]:
+            path = os.path.join(self._root, snapshot_id)
+            logging.info('Removing old deployment snapshot %r', path)
+            shutil.rmtree(path)
@@ -1,6 +1,12 @@
+import cProfile
+import errno
+import itertools
 import os
+import shlex
+import sys
 
 import common
+import metrics
 
 
 def add_extra_package(releases_tree, args):
@@ -23,8 +29,95 @@ def add_to_experiment(releases_tree, args):
                                     args.architecture)
 
 
+def _read_nodes(filename):
+    # Node lists are newline-delimited; blank lines and #-comments are
+    # skipped. Nodes are yielded as they're read so large lists stream.
+    if filename == '-':
+        handle = sys.stdin
+    else:
+        handle = open(filename)
+    try:
+        for line in handle:
+            node = line.split('#', 1)[0].strip()
+            if node:
+                yield node
+    finally:
+        if handle is not sys.stdin:
+            handle.close()
+
+
+def _nodes_from_args(args, required=True):
+    if args.file is None:
+        if required and not args.node:
+            raise Exception('Give nodes as arguments or with --file')
+        return args.node
+    return itertools.chain(args.node, _read_nodes(args.file))
+
+
 def add_to_group(releases_tree, args):
-    releases_tree.add_to_group(args.group, args.node)
+    releases_tree.add_to_group(args.group, _nodes_from_args(args))
+
+
+def _read_batch_commands(parser, handle):
+    commands = []
+    for line_number, line in enumerate(handle, 1):
+        words = shlex.split(line, comments=True)
+        if not words:
+            continue
+        try:
+            command_args = parser.parse_args(words)
+        except SystemExit:
+            raise Exception('Cannot parse batch command on line %d: %s' % (
+                line_number, line.strip()))
+        if command_args.handler in _UNBATCHABLE_HANDLERS:
+            raise Exception('Line %d: %r cannot be run in a batch' % (
+                line_number, words[0]))
+        commands.append((line_number, command_args))
+    return commands
+
+
+def batch(releases_tree, args):
+    if args.filename == '-':
+        commands = _read_batch_commands(args.parser, sys.stdin)
+    else:
+        with open(args.filename) as handle:
+            commands = _read_batch_commands(args.parser, handle)
+
+    with releases_tree.batch():
+        for line_number, command_args in commands:
+            try:
+                command_args.handler(releases_tree, command_args)
+            except Exception as e:
+                raise Exception('Batch command on line %d failed, so no '
+                                'changes were saved: %s' % (line_number, e))
+    print 'Ran %d commands' % len(commands)
+
+
+def collect_garbage(releases_tree, args):
+    garbage, reclaimed = releases_tree.collect_garbage(dry_run=args.dry_run)
+    if args.dry_run:
+        verb = 'Would remove'
+    else:
+        verb = 'Removed'
+    files = 0
+    for bismark_release, packages, filenames in garbage:
+        for package in sorted(packages):
+            print '%s %s: package %s %s %s (%s)' % (verb,
+                                                   bismark_release.name,
+                                                   package.name,
+                                                   package.version,
+                                                   package.architecture,
+                                                   package.sha1)
+        for filename in filenames:
+            print '%s %s: file %s' % (
+                verb,
+                bismark_release.name,
+                os.path.relpath(filename, bismark_release.path))
+        files += len(filenames)
+    if args.dry_run:
+        print 'Would reclaim %d bytes from %d files' % (reclaimed, files)
+    else:
+        print 'Reclaimed %d bytes from %d files' % (reclaimed, files)
 
 
 def commit(releases_tree, args):
@@ -39,18 +132,81 @@ def diff(releases_tree, args):
     releases_tree.diff()
 
 
+def define_group(releases_tree, args):
+    releases_tree.define_group(args.name, ' '.join(args.expression))
+
+
 def delete_group(releases_tree, args):
     releases_tree.delete_group(args.name)
 
 
+def _deploy(releases_tree, args):
+    if args.action == 'snapshots':
+        list_deployment_snapshots(releases_tree, args)
+    elif args.action == 'rollback':
+        releases_tree.rollback_deploy(args.snapshot,
+                                      args.destination,
+                                      compare=args.compare,
+                                      jobs=args.jobs,
+                                      atomic=args.atomic,
+                                      keep_versions=args.keep_versions)
+    else:
+        releases_tree.deploy(args.destination,
+                             args.signingkey,
+                             compare=args.compare,
+                             jobs=args.jobs,
+                             atomic=args.atomic,
+                             keep_versions=args.keep_versions,
+                             keep_snapshots=args.keep_snapshots)
+
+
 def deploy(releases_tree, args):
-    releases_tree.deploy(args.destination, args.signingkey)
+    if args.profile is not None:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        _deploy(releases_tree, args)
+    finally:
+        if args.profile is not None:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+        if args.metrics is not None:
+            metrics.write_report(args.metrics)
 
 
 def check(releases_tree, args):
     releases_tree.check_constraints()
 
 
+def verify(releases_tree, args):
+    verified = 0
+    skipped = 0
+    failures = 0
+    size = 0
+    for blob in releases_tree.verify(release_names=args.release,
+                                     sample=args.sample,
+                                     jobs=args.jobs,
+                                     resume=args.resume):
+        if blob.status == 'skipped':
+            skipped += 1
+            continue
+        if blob.status == 'missing':
+            print 'Missing %s %s in %s: %s' % (blob.kind, blob.sha1,
+                                              blob.release, blob.path)
+            failures += 1
+        elif blob.status == 'mismatch':
+            print 'Fingerprint mismatch for %s %s in %s: %s' % (
+                blob.kind, blob.sha1, blob.release, blob.path)
+            failures += 1
+        else:
+            verified += 1
+            size += blob.size
+    print '%d ok (%d bytes), %d failed, %d skipped' % (
+        verified, size, failures, skipped)
+    if failures:
+        raise Exception('%d files failed verification' % failures)
+
+
 def install_by_default(releases_tree, args):
     releases_tree.set_experiment_installed_by_default(args.experiment,
                                                       True,
@@ -64,8 +220,8 @@ def uninstall_by_default(releases_tree, args):
 
 
 def list_architectures(releases_tree, args):
-    for architecture in sorted(releases_tree.architectures(args.release)):
-        print ' '.join(architecture)
+    architectures = sorted(releases_tree.architectures(args.release))
+    _print_records(args.format, ['architecture'], architectures)
 
 
 def list_all_experiments(releases_tree, args):
@@ -74,9 +230,10 @@ def list_all_experiments(releases_tree, args):
         print_experiment_metadata(releases_tree, experiment)
 
         print 'Packages:'
-        with common.ColumnFormatter(prefix='  ') as f:
-            for package in sorted(experiment.packages):
-                print >>f, ' ', package.group, package.release, package.architecture, package.name, package.version
+        records = ((package.group, package.release, package.architecture, package.name, package.version)
+                   for package in experiment.packages)
+        _print_records('columns', _EXPERIMENT_PACKAGE_FIELDS, records,
+                       prefix='  ')
         print
 
 
@@ -85,13 +242,51 @@ def list_builtin_packages(releases_tree, args):
         releases = releases_tree.releases
     else:
         releases = [args.release]
-    with common.ColumnFormatter() as f:
-        for release_name in releases:
-            for package in sorted(releases_tree.builtin_packages(release_name)):
-                if (args.architecture is not None and
-                        package.architecture != args.architecture):
-                    continue
-                print >>f, release_name, package.architecture, package.name, package.version
+    records = ((release_name, package.architecture, package.name, package.version)
+               for release_name in releases
+               for package in releases_tree.builtin_packages(release_name)
+               if (args.architecture is None or
+                   package.architecture == args.architecture))
+    _print_records(args.format, _PACKAGE_FIELDS, records)
+
+
+_PACKAGE_FIELDS = ['release', 'architecture', 'name', 'version']
+_EXPERIMENT_PACKAGE_FIELDS = ['group', 'release', 'architecture', 'name', 'version']
+_UPGRADE_FIELDS = ['group', 'release', 'architecture', 'name', 'version']
+
+
+def _print_records(output_format, fields, records, prefix=''):
+    # Columns are aligned and sorted, so they wait for every record; other
+    # formats stream records as they're produced, in the order produced.
+    if output_format != 'columns':
+        try:
+            with common.record_formatter(output_format, fields) as f:
+                for record in records:
+                    f.write_record(record)
+        except IOError as e:
+            # The reader (e.g., head) has seen enough.
+            if e.errno != errno.EPIPE:
+                raise
+        return
+    if len(fields) == 1:
+        for record in records:
+            print '%s%s' % (prefix, record[0])
+        return
+    records = list(records)
+    if 'version' in fields:
+        # Versions are ordered the way opkg orders them (so 1.10 comes after
+        # 1.9), not alphabetically.
+        import opkg
+        position = fields.index('version')
+        records.sort(key=lambda record: (
+            tuple(record[:position]),
+            opkg.version_key(record[position]),
+            tuple(record[position + 1:])))
+    else:
+        records.sort()
+    with common.ColumnFormatter(prefix=prefix, sort=False) as f:
+        for record in records:
+            f.write_record(record)
 
 
 def print_experiment_metadata(releases_tree, experiment):
@@ -112,24 +307,36 @@ def print_experiment_metadata(releases_tree, experiment):
     print 'Implicit conflicts:', ', '.join(implicit_conflicts)
 
 
+def list_deployment_snapshots(releases_tree, args):
+    snapshots = releases_tree.deployment_snapshots
+    records = ((snapshot_id,
+                snapshots[snapshot_id].info.get('created', '-').replace(' ', 'T'),
+                snapshots[snapshot_id].info.get('destination', '-'))
+               for snapshot_id in snapshots)
+    _print_records(args.format, ['snapshot', 'created', 'destination'],
+                   records)
+
+
 def list_experiment(releases_tree, args):
     if args.experiment is None:
-        for name in sorted(releases_tree.experiments):
-            print name
+        _print_records(args.format,
+                       ['experiment'],
+                       ((name,) for name in sorted(releases_tree.experiments)))
         return
 
     experiment = releases_tree.experiments[args.experiment]
     print_experiment_metadata(releases_tree, experiment)
     print 'Packages:'
-    with common.ColumnFormatter(prefix='  ') as f:
-        for package in sorted(releases_tree.experiment_packages(args.experiment)):
-            print >>f, ' ', package.group, package.release, package.architecture, package.name, package.version
+    records = ((package.group, package.release, package.architecture, package.name, package.version)
+               for package in releases_tree.experiment_packages(args.experiment))
+    _print_records('columns', _EXPERIMENT_PACKAGE_FIELDS, records,
+                   prefix='  ')
 
 
 def list_experiment_packages(releases_tree, args):
-    with common.ColumnFormatter() as f:
-        for package in sorted(releases_tree.experiment_packages(args.experiment)):
-            print >>f, package.group, package.release, package.architecture, package.name, package.version
+    records = ((package.group, package.release, package.architecture, package.name, package.version)
+               for package in releases_tree.experiment_packages(args.experiment))
+    _print_records(args.format, _EXPERIMENT_PACKAGE_FIELDS, records)
 
 
 def list_extra_packages(releases_tree, args):
@@ -137,27 +344,42 @@ def list_extra_packages(releases_tree, args):
         releases = releases_tree.releases
     else:
         releases = [args.release]
-    with common.ColumnFormatter() as f:
-        for release_name in releases:
-            for package in releases_tree.extra_packages(release_name):
-                if (args.architecture is not None and
-                        package.architecture != args.architecture):
-                    continue
-                print >>f, release_name, package.architecture, package.name, package.version
+    records = ((release_name, package.architecture, package.name, package.version)
+               for release_name in releases
+               for package in releases_tree.extra_packages(release_name)
+               if (args.architecture is None or
+                   package.architecture == args.architecture))
+    _print_records(args.format, _PACKAGE_FIELDS, records)
 
 
 def list_group(releases_tree, args):
     if args.name is None:
-        for group in releases_tree.groups:
-            print group
+        _print_records(args.format,
+                       ['group'],
+                       ((group,) for group in releases_tree.groups))
     else:
-        for node in sorted(releases_tree.nodes_in_group(args.name)):
-            print node
+        nodes = sorted(releases_tree.nodes_in_group(args.name))
+        _print_records(args.format, ['node'], ((node,) for node in nodes))
+
+
+def which_groups(releases_tree, args):
+    groups = sorted(releases_tree.groups_containing(args.node))
+    _print_records(args.format, ['group'], ((group,) for group in groups))
 
 
 def list_all_groups(releases_tree, args):
+    if args.format != 'columns':
+        records = ((group, node)
+                   for group in sorted(releases_tree.groups)
+                   for node in sorted(releases_tree.nodes_in_group(group)))
+        _print_records(args.format, ['group', 'node'], records)
+        return
     for group in sorted(releases_tree.groups):
-        print group
+        expression = releases_tree.group_expression(group)
+        if expression is None:
+            print group
+        else:
+            print group, '=', expression
         for node in sorted(releases_tree.nodes_in_group(group)):
             print ' ', node
 
@@ -167,15 +389,16 @@ def list_packages(releases_tree, args):
         releases = releases_tree.releases
     else:
         releases = [args.release]
-    with common.ColumnFormatter() as f:
-        for release_name in releases:
-            for package in releases_tree.packages(release_name):
-                print >>f, release_name, package.architecture, package.name, package.version
+    records = ((release_name, package.architecture, package.name, package.version)
+               for release_name in releases
+               for package in releases_tree.packages(release_name))
+    _print_records(args.format, _PACKAGE_FIELDS, records)
 
 
 def list_releases(releases_tree, args):
-    for release_name in releases_tree.releases:
-        print release_name
+    _print_records(args.format,
+                   ['release'],
+                   ((release_name,) for release_name in releases_tree.releases))
 
 
 def list_upgrades(releases_tree, args):
@@ -183,10 +406,69 @@ def list_upgrades(releases_tree, args):
         releases = releases_tree.releases
     else:
         releases = [args.release]
-    with common.ColumnFormatter() as f:
-        for release_name in releases:
-            for upgrade in releases_tree.upgrades(release_name):
-                print >>f, upgrade.group, release_name, upgrade.architecture, upgrade.name, upgrade.version
+    records = ((upgrade.group, release_name, upgrade.architecture, upgrade.name, upgrade.version)
+               for release_name in releases
+               for upgrade in releases_tree.upgrades(release_name))
+    _print_records(args.format, _UPGRADE_FIELDS, records)
+
+
+def diff_releases(releases_tree, args):
+    differences = releases_tree.diff_releases(args.old_release,
+                                              args.new_release)
+    _print_records(args.format,
+                   ['category', 'architecture', 'name', 'group', 'change',
+                    'old_version', 'new_version'],
+                   differences)
+
+
+def show_node(releases_tree, args):
+    if args.release is None:
+        releases = sorted(releases_tree.releases)
+    else:
+        releases = [args.release]
+    fields = ['release', 'architecture', 'source', 'name', 'version',
+              'experiment']
+    if args.format != 'columns':
+        records = (package
+                   for release_name in releases
+                   for package in releases_tree.node_packages(args.node,
+                                                              release_name))
+        _print_records(args.format, fields, records)
+        return
+
+    print 'Node:', args.node
+    print 'Groups:', ', '.join(sorted(releases_tree.groups_containing(args.node)))
+    for release_name in releases:
+        print
+        print 'Release:', release_name
+        print 'Packages:'
+        _print_records(args.format,
+                       fields,
+                       releases_tree.node_packages(args.node, release_name),
+                       prefix='  ')
+        configurations = releases_tree.node_experiment_configurations(
+            args.node, release_name)
+        for architecture, configuration in configurations:
+            print 'Experiments (%s):' % architecture
+            if not configuration:
+                print '  none'
+            for line in configuration.rstrip('\n').splitlines():
+                print ' ', line
+
+
+def query_packages(releases_tree, args):
+    references = releases_tree.query_packages(name=args.name,
+                                              version=args.version,
+                                              architecture=args.architecture,
+                                              sha1=args.sha1,
+                                              release=args.release,
+                                              experiment=args.experiment,
+                                              group=args.group,
+                                              usage=args.usage)
+    _print_records(args.format,
+                   ['name', 'version', 'architecture', 'release', 'usage',
+                    'group', 'experiment', 'sha1'],
+                   references)
 
 
 def new_experiment(releases_tree, args):
@@ -195,9 +477,32 @@ def new_experiment(releases_tree, args):
     releases_tree.new_experiment(args.name, display_name, description)
 
 
+def import_to_group(releases_tree, args):
+    releases_tree.import_to_group(args.group,
+                                  _read_nodes(args.filename),
+                                  mode=args.mode,
+                                  with_group=args.with_group)
+
+
 def new_group(releases_tree, args):
-    releases_tree.new_group(args.name)
-    releases_tree.add_to_group(args.name, args.node)
+    releases_tree.new_group(args.name,
+                            _nodes_from_args(args, required=False))
+
+
+def clone_release(releases_tree, args):
+    if args.buildroot is None:
+        openwrt_build_root = None
+    else:
+        openwrt_build_root = os.path.expanduser(args.buildroot)
+    dropped_upgrades = releases_tree.clone_release(args.source,
+                                                   args.name,
+                                                   openwrt_build_root)
+    for upgrade in dropped_upgrades:
+        print 'Dropped upgrade of %s to %s (%s) for group %s, which is no ' \
+            'longer newer than the builtin package' % (upgrade.name,
+                                                       upgrade.version,
+                                                       upgrade.architecture,
+                                                       upgrade.group)
 
 
 def new_release(releases_tree, args):
@@ -222,7 +527,7 @@ def remove_from_experiment(releases_tree, args):
 
 
 def remove_from_group(releases_tree, args):
-    releases_tree.remove_from_group(args.group, args.node)
+    releases_tree.remove_from_group(args.group, _nodes_from_args(args))
 
 
 def require_experiment(releases_tree, args):
@@ -247,3 +552,17 @@ def upgrade_package(releases_tree, args):
                                   args.version,
                                   args.architecture,
                                   args.group)
+
+
+# These commands write outside the tree's metadata, prompt for input, or
+# need the tree to be saved first.
+_UNBATCHABLE_HANDLERS = set([
+    batch,
+    clone_release,
+    collect_garbage,
+    commit,
+    deploy,
+    diff,
+    new_experiment,
+    new_release,
+])
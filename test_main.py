@@ -0,0 +1,43 @@
+import unittest
+
+import main
+
+
+class DeploySubcommandTest(unittest.TestCase):
+
+    def setUp(self):
+        self._parser = main.create_parser()
+
+    def _parse(self, argv):
+        return self._parser.parse_args(main._default_deploy_subcommand(argv))
+
+    def test_plain_deploy_publishes(self):
+        args = self._parse(['deploy', '--jobs', '4'])
+        self.assertEqual('publish', args.action)
+        self.assertEqual(4, args.jobs)
+
+    def test_options_before_and_after_subcommand(self):
+        args = self._parse(['deploy', '--jobs', '2', 'rollback', 'snap',
+                            '-d', '/tmp/destination'])
+        self.assertEqual('rollback', args.action)
+        self.assertEqual('snap', args.snapshot)
+        self.assertEqual(2, args.jobs)
+        self.assertEqual('/tmp/destination', args.destination)
+        self.assertEqual(3, args.keep_versions)
+
+    def test_option_value_named_like_subcommand(self):
+        args = self._parse(['deploy', '-d', 'rollback'])
+        self.assertEqual('publish', args.action)
+        self.assertEqual('rollback', args.destination)
+
+    def test_group_named_deploy(self):
+        for argv in [['groups', 'new', 'deploy', 'n1', 'n2'],
+                     ['groups', 'add-nodes', 'deploy', 'n3'],
+                     ['--root', 'deploy', 'groups', 'list']]:
+            self.assertEqual(argv, main._default_deploy_subcommand(argv))
+        args = self._parse(['groups', 'new', 'deploy', 'n1', 'n2'])
+        self.assertEqual(['n1', 'n2'], args.node)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+import os
+import shutil
+import StringIO
+import subprocess
+import tarfile
+import tempfile
+import unittest
+
+import tree
+
+
+def _targz(members):
+    contents = StringIO.StringIO()
+    handle = tarfile.open(fileobj=contents, mode='w:gz')
+    for name, data in members:
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        handle.addfile(info, StringIO.StringIO(data))
+    handle.close()
+    return contents.getvalue()
+
+
+def _write_ipk(filename, name, version):
+    control = ('Package: %s\nVersion: %s\nArchitecture: ar71xx\n'
+               'Description: %s\n' % (name, version, name))
+    with open(filename, 'wb') as handle:
+        handle.write(_targz([('./debian-binary', '2.0\n'),
+                             ('./data.tar.gz', _targz([])),
+                             ('./control.tar.gz',
+                              _targz([('./control', control)]))]))
+    return control
+
+
+def _make_build(build_root):
+    info_path = os.path.join(build_root, 'build_dir', 'target-mips',
+                             'root-ar71xx', 'usr', 'lib', 'opkg', 'info')
+    packages_path = os.path.join(build_root, 'bin', 'ar71xx', 'packages')
+    os.makedirs(info_path)
+    os.makedirs(packages_path)
+    with open(os.path.join(build_root, '.config'), 'w') as handle:
+        handle.write('\n')
+    control = _write_ipk(os.path.join(packages_path, 'libc_1_ar71xx.ipk'),
+                         'libc',
+                         '1')
+    with open(os.path.join(info_path, 'libc.control'), 'w') as handle:
+        handle.write(control)
+
+
+class NodeShowMatchesDeploymentTest(unittest.TestCase):
+
+    def setUp(self):
+        self._path = tempfile.mkdtemp()
+        build_root = os.path.join(self._path, 'build')
+        _make_build(build_root)
+        self._signing_key = os.path.join(self._path, 'key.pem')
+        subprocess.check_call(
+            ['openssl', 'req', '-x509', '-newkey', 'rsa:1024', '-nodes',
+             '-keyout', self._signing_key, '-out', self._signing_key,
+             '-subj', '/CN=test', '-days', '1'],
+            stdout=open(os.devnull, 'w'),
+            stderr=subprocess.STDOUT)
+        os.chmod(self._signing_key, 0400)
+
+        self._tree = tree.BismarkReleasesTree(
+            os.path.join(self._path, 'releases'))
+        self._tree.new_release('quirm', build_root)
+        filenames = []
+        for version in ['1.0', '2.0']:
+            filename = os.path.join(self._path, 'foo_%s.ipk' % version)
+            _write_ipk(filename, 'foo', version)
+            filenames.append(filename)
+        self._tree.add_packages('quirm', filenames)
+        self._tree.new_group('pinned', ['n1'])
+        self._tree.new_experiment('Foo', 'Foo', 'Foo experiment')
+        self._tree.add_to_experiment(
+            'Foo', 'default', 'quirm', 'foo', '2.0', 'ar71xx')
+        self._tree.add_to_experiment(
+            'Foo', 'pinned', 'quirm', 'foo', '1.0', 'ar71xx')
+
+    def tearDown(self):
+        shutil.rmtree(self._path)
+
+    def _shown_versions(self, node):
+        versions = set()
+        for node_package in self._tree.node_packages(node, 'quirm'):
+            if node_package.source == 'experiment':
+                versions.add((node_package.name, node_package.version))
+        return versions
+
+    def _staged_versions(self, deployment_path, directory):
+        versions = set()
+        path = os.path.join(deployment_path, 'quirm', 'ar71xx', directory)
+        for filename in os.listdir(path):
+            if filename.endswith('.ipk'):
+                name, version, _ = filename[:-len('.ipk')].split('_')
+                versions.add((name, version))
+        return versions
+
+    def test_overriding_group(self):
+        deployment_path = self._tree.stage_deployment(
+            self._signing_key, os.path.join(self._path, 'deployment'))
+        self.assertEqual(
+            set([('foo', '1.0')]),
+            self._staged_versions(deployment_path, 'experiments-device/n1'))
+        self.assertEqual(self._staged_versions(deployment_path,
+                                               'experiments-device/n1'),
+                         self._shown_versions('n1'))
+
+    def test_node_in_two_groups(self):
+        filename = os.path.join(self._path, 'foo_3.0.ipk')
+        _write_ipk(filename, 'foo', '3.0')
+        self._tree.add_packages('quirm', [filename])
+        self._tree.new_group('newer', ['n1'])
+        self._tree.add_to_experiment(
+            'Foo', 'newer', 'quirm', 'foo', '3.0', 'ar71xx')
+        deployment_path = self._tree.stage_deployment(
+            self._signing_key, os.path.join(self._path, 'deployment'))
+        # n1 is offered foo 1.0 by "pinned" and 3.0 by "newer", and gets the
+        # latest.
+        self.assertEqual(
+            set([('foo', '3.0')]),
+            self._staged_versions(deployment_path, 'experiments-device/n1'))
+        self.assertEqual(self._staged_versions(deployment_path,
+                                               'experiments-device/n1'),
+                         self._shown_versions('n1'))
+
+    def test_default_node(self):
+        deployment_path = self._tree.stage_deployment(
+            self._signing_key, os.path.join(self._path, 'deployment'))
+        # Nodes without a directory of their own use the default one.
+        self.assertEqual(
+            set([('foo', '2.0')]),
+            self._staged_versions(deployment_path,
+                                  'experiments-device/default'))
+        self.assertEqual(self._staged_versions(deployment_path,
+                                               'experiments-device/default'),
+                         self._shown_versions('n2'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,28 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import publish
+
+
+class PruneVersionsTest(unittest.TestCase):
+
+    def setUp(self):
+        self._path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self._path)
+
+    def test_same_second_versions(self):
+        names = ['deploy-20140301-153012'] + [
+            'deploy-20140301-153012.%d' % suffix for suffix in range(1, 11)]
+        for name in names:
+            os.mkdir(os.path.join(self._path, name))
+        os.symlink(names[-1], os.path.join(self._path, 'current'))
+        publish._prune_versions(self._path, 3)
+        self.assertEqual(names[-3:], publish.versions(self._path))
+
+
+if __name__ == '__main__':
+    unittest.main()
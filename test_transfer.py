@@ -0,0 +1,99 @@
+import distutils.spawn
+import os
+import shutil
+import tempfile
+import unittest
+
+import deploy
+import transfer
+
+
+def _write(root, relative_path, contents):
+    path = os.path.join(root, relative_path)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as handle:
+        handle.write(contents)
+
+
+def _snapshot(root):
+    # Every file, directory and symlink under root, with file contents.
+    entries = set()
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in dirnames + filenames:
+            path = os.path.join(dirpath, name)
+            relative_path = os.path.relpath(path, root)
+            if os.path.islink(path):
+                entries.add((relative_path, 'symlink', os.readlink(path)))
+            elif os.path.isdir(path):
+                entries.add((relative_path, 'directory', ''))
+            else:
+                with open(path) as handle:
+                    entries.add((relative_path, 'file', handle.read()))
+    return entries
+
+
+class ShardedCopyTest(unittest.TestCase):
+
+    def setUp(self):
+        self._path = tempfile.mkdtemp()
+        self._deployment_path = os.path.join(self._path, 'deployment')
+        for relative_path, contents in [
+                ('index.html', 'index'),
+                ('packages/Packages.gz', 'index of packages'),
+                ('packages/ar71xx/foo_1.0_ar71xx.ipk', 'foo'),
+                ('packages/all/bar_2.0_all.ipk', 'bar'),
+                ('quirm/ar71xx/Packages.gz', 'quirm packages'),
+                ('quirm/ar71xx/experiments-device/n1/Experiments', 'n1')]:
+            _write(self._deployment_path, relative_path, contents)
+        os.symlink('quirm', os.path.join(self._deployment_path, 'latest'))
+
+    def tearDown(self):
+        shutil.rmtree(self._path)
+
+    def _stale_destination(self, name):
+        # A destination holding an older deployment, with files that are
+        # gone from the staging tree at every level.
+        destination = os.path.join(self._path, name)
+        for relative_path, contents in [
+                ('index.html', 'old index'),
+                ('stale.html', 'stale'),
+                ('lancre/ar71xx/Packages.gz', 'stale release'),
+                ('packages/stale.gz', 'stale'),
+                ('packages/ar71xx/foo_0.9_ar71xx.ipk', 'old foo'),
+                ('packages/mips/baz_1.0_mips.ipk', 'stale architecture'),
+                ('quirm/ar71xx/experiments-device/n2/Experiments', 'n2')]:
+            _write(destination, relative_path, contents)
+        return destination
+
+    def test_plan_shards(self):
+        containers, shards = transfer.plan_shards(self._deployment_path)
+        self.assertEqual(['', 'packages'], containers)
+        self.assertEqual(['packages/all', 'packages/ar71xx', 'quirm'], shards)
+
+    @unittest.skipUnless(distutils.spawn.find_executable('rsync'),
+                         'rsync is not installed')
+    def test_matches_single_stream(self):
+        sharded = self._stale_destination('sharded')
+        single = self._stale_destination('single')
+        self.assertTrue(transfer.parallel_copy(self._deployment_path,
+                                               sharded,
+                                               3))
+        self.assertTrue(deploy._copy_to_destination(self._deployment_path,
+                                                    single))
+
+        self.assertEqual(_snapshot(self._deployment_path), _snapshot(single))
+        self.assertEqual(_snapshot(single), _snapshot(sharded))
+        for relative_path in ['stale.html',
+                              'lancre',
+                              'packages/stale.gz',
+                              'packages/ar71xx/foo_0.9_ar71xx.ipk',
+                              'packages/mips',
+                              'quirm/ar71xx/experiments-device/n2']:
+            self.assertFalse(
+                os.path.lexists(os.path.join(sharded, relative_path)),
+                relative_path)
+
+
+if __name__ == '__main__':
+    unittest.main()
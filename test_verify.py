@@ -0,0 +1,61 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+import verify
+
+
+class CheckpointTest(unittest.TestCase):
+
+    def setUp(self):
+        self._path = tempfile.mkdtemp()
+        self._checkpoint = os.path.join(self._path, '.cache', 'checkpoint')
+        self._blobs = []
+        for index in range(4):
+            contents = 'blob %d' % index
+            filename = os.path.join(self._path, '%d.ipk' % index)
+            with open(filename, 'w') as handle:
+                handle.write(contents)
+            self._blobs.append(verify.Blob('quirm',
+                                           'package',
+                                           filename,
+                                           hashlib.sha1(contents).hexdigest()))
+
+    def tearDown(self):
+        shutil.rmtree(self._path)
+
+    def _statuses(self, blobs, **kwargs):
+        return sorted(blob.status
+                      for blob in verify.verify_blobs(blobs,
+                                                      self._checkpoint,
+                                                      jobs=2,
+                                                      **kwargs))
+
+    def _interrupted_run(self):
+        # A full run that stopped after verifying two blobs.
+        for index, _ in enumerate(
+                verify.verify_blobs(self._blobs, self._checkpoint, jobs=1)):
+            if index == 1:
+                break
+
+    def test_partial_runs_keep_checkpoint(self):
+        self._interrupted_run()
+        self.assertEqual(['ok'],
+                         self._statuses(self._blobs[3:], resume=True,
+                                        complete=False))
+        self.assertEqual(['ok'],
+                         self._statuses(self._blobs[2:3], complete=False))
+        self.assertEqual(['skipped'] * 4,
+                         self._statuses(self._blobs, resume=True))
+        self.assertFalse(os.path.exists(self._checkpoint))
+
+    def test_full_run_without_resume_starts_afresh(self):
+        self._interrupted_run()
+        self.assertEqual(['ok'] * 4, self._statuses(self._blobs))
+        self.assertFalse(os.path.exists(self._checkpoint))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+from multiprocessing.pool import ThreadPool
+import glob
+import logging
+import os
+import subprocess
+
+# These files are already compressed, so asking rsync to compress them again
+# only burns CPU on both ends.
+_INCOMPRESSIBLE_SUFFIXES = [
+    'bin',
+    'bz2',
+    'gz',
+    'img',
+    'ipk',
+    'jpg',
+    'png',
+    'sig',
+    'tgz',
+    'trx',
+    'xz',
+    'zip',
+]
+
+# Directories whose children are transferred as separate shards. The root of
+# the staging tree is always sharded this way.
+_SHARDED_DIRECTORIES = [
+    'packages',
+]
+
+
+# Containers are synchronized non-recursively, which creates their
+# subdirectories, copies their files, and deletes anything that no longer
+# exists in the staging tree. Shards are the subdirectories of containers,
+# each synchronized recursively by its own rsync stream.
+def plan_shards(deployment_path):
+    containers = ['']
+    shards = []
+    for name in sorted(os.listdir(deployment_path)):
+        path = os.path.join(deployment_path, name)
+        if os.path.islink(path) or not os.path.isdir(path):
+            continue
+        if name in _SHARDED_DIRECTORIES:
+            containers.append(name)
+            pattern = os.path.join(path, '*')
+            for subdirectory in sorted(glob.iglob(pattern)):
+                if os.path.islink(subdirectory) or not os.path.isdir(subdirectory):
+                    continue
+                shards.append(os.path.relpath(subdirectory, deployment_path))
+        else:
+            shards.append(name)
+    return containers, shards
+
+
+def _join_destination(destination, relative_path):
+    if relative_path == '':
+        return destination.rstrip('/') + '/'
+    return '%s/%s/' % (destination.rstrip('/'), relative_path)
+
+
+def _join_source(deployment_path, relative_path):
+    return os.path.join(deployment_path, relative_path, '')
+
+
+def _rsync_command(source, destination, recursive, compare):
+    flags = ['-lptgoDvz', '--delete']
+    if recursive:
+        flags.append('-r')
+    else:
+        flags.append('-d')
+    if compare == 'checksum':
+        flags.append('-c')
+    flags.append('--skip-compress=%s' % '/'.join(_INCOMPRESSIBLE_SUFFIXES))
+    return 'rsync %s %s %s' % (' '.join(flags), source, destination)
+
+
+def _run(command):
+    logging.info('Going to run: %s', command)
+    return_code = subprocess.call(command, shell=True)
+    if return_code != 0:
+        logging.error('rsync exited with error code %d', return_code)
+    return return_code
+
+
+def parallel_copy(deployment_path, destination, jobs, compare='checksum'):
+    # Containers go first, one at a time, so every shard's destination
+    # directory exists before the shards run. Each shard only deletes files
+    # within its own subtree, so concurrent streams never race on --delete.
+    containers, shards = plan_shards(deployment_path)
+    for container in containers:
+        command = _rsync_command(_join_source(deployment_path, container),
+                                 _join_destination(destination, container),
+                                 False,
+                                 compare)
+        if _run(command) != 0:
+            print 'rsync failed for %s' % (container or '/',)
+            return False
+
+    commands = []
+    for shard in shards:
+        commands.append(_rsync_command(_join_source(deployment_path, shard),
+                                       _join_destination(destination, shard),
+                                       True,
+                                       compare))
+    pool = ThreadPool(max(1, jobs))
+    try:
+        return_codes = pool.map(_run, commands)
+    finally:
+        pool.close()
+        pool.join()
+
+    success = True
+    for shard, return_code in zip(shards, return_codes):
+        if return_code != 0:
+            print 'rsync failed for %s with error code %d' % (shard,
+                                                              return_code)
+            success = False
+    return success
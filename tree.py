@@ -1,13 +1,12 @@
+import contextlib
 import glob
 import logging
 import os
+import shutil
 import subprocess
 
 import common
-import deploy
-import experiments
 import groups
-import openwrt
 import release
 
 
@@ -17,19 +16,90 @@ class BismarkReleasesTree(object):
         self._root = root
         common.makedirs(root)
 
-        self._experiments = experiments.Experiments(self._experiments_path())
+        self._loaded_experiments = None
+
+        # While a batch is open, releases and groups are opened once and
+        # kept here, and nothing is written until the batch ends.
+        self._batching = False
+        self._batch_releases = {}
+        self._batch_groups = None
 
     def new_release(self, name, build_root):
         release_path = self._release_path(name)
         if os.path.isdir(release_path):
             raise Exception('Release %r already exists' % name)
 
+        # The deploy, experiments, nodes, openwrt, query, snapshots and verify
+        # modules are expensive to import or only needed by a few commands,
+        # so the methods that use them import them and commands like
+        # "groups list" start quickly.
+        import openwrt
         openwrt_build = openwrt.BuildTree(build_root)
         bismark_release = release.new_bismark_release(
             release_path,
             openwrt_build)
         bismark_release.save()
 
+    def clone_release(self, source_name, name, build_root=None):
+        release_path = self._release_path(name)
+        if os.path.isdir(release_path):
+            raise Exception('Release %r already exists' % name)
+        source_release = self._open_release(source_name)
+
+        if build_root is None:
+            openwrt_build = None
+        else:
+            import openwrt
+            openwrt_build = openwrt.BuildTree(build_root)
+        try:
+            bismark_release, dropped_upgrades = release.clone_bismark_release(
+                source_release, release_path, openwrt_build)
+            bismark_release.save()
+        except:
+            shutil.rmtree(release_path, ignore_errors=True)
+            raise
+        return dropped_upgrades
+
+    def collect_garbage(self, dry_run=False):
+        garbage = []
+        for bismark_release in self._open_releases():
+            packages, filenames = bismark_release.garbage(
+                self._experiment_packages(bismark_release.name))
+            garbage.append((bismark_release, packages, filenames))
+        all_filenames = [filename
+                         for _, _, filenames in garbage
+                         for filename in filenames]
+        reclaimed = common.reclaimable_bytes(all_filenames)
+        if dry_run:
+            return garbage, reclaimed
+
+        # Metadata goes first, so an interruption leaves only unreferenced
+        # files, which the next run removes.
+        for bismark_release, packages, _ in garbage:
+            if packages:
+                bismark_release.remove_packages(packages)
+                bismark_release.save(check=False)
+        for filename in all_filenames:
+            logging.info('Removing %r', filename)
+            os.remove(filename)
+        return garbage, reclaimed
+
+    def verify(self, release_names=None, sample=None, jobs=None,
+               resume=False):
+        import verify
+        if not release_names:
+            release_names = sorted(self.releases)
+        blobs = verify.release_blobs(
+            self._open_release(release_name) for release_name in release_names)
+        if sample is not None:
+            blobs = verify.sample_blobs(blobs, sample)
+        complete = sample is None and set(release_names) >= self.releases
+        return verify.verify_blobs(blobs,
+                                   self._verify_checkpoint_path(),
+                                   jobs=jobs,
+                                   resume=resume,
+                                   complete=complete)
+
     @property
     def releases(self):
         releases = set()
@@ -48,104 +118,140 @@ class BismarkReleasesTree(object):
 
     def builtin_packages(self, release_name):
         logging.info('Getting builtin packages for release %r', release_name)
-        bismark_release = release.open_bismark_release(
-            self._release_path(release_name))
+        bismark_release = self._open_release(release_name)
         return bismark_release.builtin_packages
 
     def extra_packages(self, release_name):
         logging.info('Getting extra packages for release %r', release_name)
-        bismark_release = release.open_bismark_release(
-            self._release_path(release_name))
+        bismark_release = self._open_release(release_name)
         return bismark_release.extra_packages
 
     def architectures(self, release_name):
         logging.info('Getting architectures for release %r', release_name)
-        bismark_release = release.open_bismark_release(
-            self._release_path(release_name))
+        bismark_release = self._open_release(release_name)
         return bismark_release.architectures
 
     def packages(self, release_name):
         logging.info('Getting packages for release %r', release_name)
-        bismark_release = release.open_bismark_release(
-            self._release_path(release_name))
+        bismark_release = self._open_release(release_name)
         return bismark_release.packages
 
     @property
     def experiments(self):
-        logging.info('Getting all experiments %r')
+        logging.info('Getting all experiments')
         return self._experiments
 
+    @property
+    def _experiments(self):
+        if self._loaded_experiments is None:
+            import experiments
+            self._loaded_experiments = experiments.Experiments(
+                self._experiments_path())
+        return self._loaded_experiments
+
     def experiment_packages(self, experiment_name):
         logging.info('Getting packages for experiment %r', experiment_name)
         return self._experiments[experiment_name].packages
 
     def add_packages(self, release_name, filenames):
-        bismark_release = release.open_bismark_release(
-            self._release_path(release_name))
+        bismark_release = self._open_release(release_name)
         for filename in filenames:
             logging.info('Add package %r to release %r',
                          filename,
                          release_name)
             bismark_release.add_package(filename)
-        bismark_release.save()
+        self._save_release(bismark_release)
 
     def add_extra_package(self, release_name, *rest):
-        bismark_release = release.open_bismark_release(
-            self._release_path(release_name))
+        bismark_release = self._open_release(release_name)
         bismark_release.add_extra_package(*rest)
-        bismark_release.save()
+        self._save_release(bismark_release)
 
     def remove_extra_package(self, release_name, *rest):
-        bismark_release = release.open_bismark_release(
-            self._release_path(release_name))
+        bismark_release = self._open_release(release_name)
         bismark_release.remove_extra_package(*rest)
-        bismark_release.save()
+        self._save_release(bismark_release)
 
     @property
     def groups(self):
         logging.info('Getting groups')
-        return groups.NodeGroups(self._groups_path())
+        return self._open_groups()
 
     def nodes_in_group(self, name):
         logging.info('Getting nodes for group %r', name)
-        node_groups = groups.NodeGroups(self._groups_path())
+        node_groups = self._open_groups()
         return node_groups[name]
 
-    def new_group(self, name):
+    def groups_containing(self, node):
+        logging.info('Getting groups containing node %r', node)
+        node_groups = self._open_groups()
+        return node_groups.groups_containing(node)
+
+    def group_expression(self, name):
+        node_groups = self._open_groups()
+        if not node_groups.is_derived(name):
+            return None
+        return node_groups.expression(name)
+
+    def define_group(self, name, expression):
+        logging.info('Defining group %r as %r', name, expression)
+        node_groups = self._open_groups()
+        node_groups.define_group(name, expression)
+        self._save_groups(node_groups)
+
+    def new_group(self, name, nodes=()):
         logging.info('Creating group %r', name)
-        node_groups = groups.NodeGroups(self._groups_path())
+        node_groups = self._open_groups()
         node_groups.new_group(name)
-        node_groups.write_to_files()
+        node_groups.add_nodes(name, nodes)
+        self._save_groups(node_groups)
 
     def copy_group(self, name, new_name):
         logging.info('Creating group %r', name)
-        node_groups = groups.NodeGroups(self._groups_path())
+        node_groups = self._open_groups()
         node_groups.new_group(new_name)
-        for node in node_groups[name]:
-            node_groups[new_name].add(node)
-        node_groups.write_to_files()
+        node_groups.add_nodes(new_name, node_groups[name])
+        self._save_groups(node_groups)
 
     def delete_group(self, name):
         logging.info('Deleting group %r', name)
-        node_groups = groups.NodeGroups(self._groups_path())
+        node_groups = self._open_groups()
         del node_groups[name]
-        node_groups.write_to_files()
+        self._save_groups(node_groups)
 
     def add_to_group(self, name, nodes):
         logging.info('Adding to group %r', name)
-        node_groups = groups.NodeGroups(self._groups_path())
-        for node in nodes:
-            logging.info('Adding node %r to group %r', node, name)
-            node_groups[name].add(node)
-        node_groups.write_to_files()
+        node_groups = self._open_groups()
+        node_groups.add_nodes(name, nodes)
+        self._save_groups(node_groups)
 
     def remove_from_group(self, name, nodes):
         logging.info('Removing from group %r', name)
-        node_groups = groups.NodeGroups(self._groups_path())
-        for node in nodes:
-            logging.info('Removing node %r from group %r', node, name)
-            node_groups[name].remove(node)
-        node_groups.write_to_files()
+        node_groups = self._open_groups()
+        node_groups.remove_nodes(name, nodes)
+        self._save_groups(node_groups)
+
+    def import_to_group(self, name, nodes, mode='add', with_group=None):
+        logging.info('Importing nodes into group %r (%s)', name, mode)
+        node_groups = self._open_groups()
+        if name not in node_groups:
+            if mode not in ['add', 'replace']:
+                raise KeyError(name)
+            node_groups.new_group(name)
+        if with_group is not None:
+            other_nodes = node_groups[with_group]
+            nodes = (node for node in nodes if node in other_nodes)
+        if mode == 'add':
+            node_groups.add_nodes(name, nodes)
+        elif mode == 'remove':
+            node_groups.discard_nodes(name, nodes)
+        elif mode == 'replace':
+            node_groups.replace_nodes(name, nodes)
+        elif mode == 'intersect':
+            node_groups.intersect_nodes(name, nodes)
+        else:
+            raise Exception('Unknown import mode %r' % mode)
+        self._save_groups(node_groups)
 
     def upgrade_package(self,
                         release_name,
@@ -159,29 +265,61 @@ class BismarkReleasesTree(object):
                      version,
                      architecture,
                      release_name)
-        bismark_release = release.open_bismark_release(
-            self._release_path(release_name))
+        bismark_release = self._open_release(release_name)
         bismark_release.upgrade_package(group_name,
                                         name,
                                         version,
                                         architecture)
-        bismark_release.save()
+        self._save_release(bismark_release)
 
     def upgrades(self, release_name):
-        bismark_release = release.open_bismark_release(
-            self._release_path(release_name))
+        bismark_release = self._open_release(release_name)
         return bismark_release.package_upgrades
 
+    def diff_releases(self, old_release_name, new_release_name):
+        logging.info('Comparing release %r to %r',
+                     old_release_name,
+                     new_release_name)
+        return release.diff_releases(self._open_release(old_release_name),
+                                     self._open_release(new_release_name))
+
+    def node_packages(self, node, release_name):
+        import nodes
+        return nodes.node_packages(self._open_release(release_name),
+                                   self._experiments,
+                                   self._open_groups(),
+                                   node)
+
+    def node_experiment_configurations(self, node, release_name):
+        import nodes
+        return nodes.experiment_configurations(
+            self._open_release(release_name),
+            self._experiments,
+            self._open_groups(),
+            node)
+
+    def query_packages(self, **filters):
+        import query
+        if self._batching:
+            # The cache reflects what's on disk, not the batch's changes.
+            index = query.PackageIndex(query.build_references(
+                self._open_releases(), self._experiments))
+        else:
+            index = query.open_index(self._root,
+                                     self._package_index_path(),
+                                     self._open_releases,
+                                     lambda: self._experiments)
+        return index.query(**filters)
+
     def new_experiment(self, name, display_name, description):
         logging.info('Creating new experiment %s', name)
         self._experiments.new_experiment(name, display_name, description)
-        self._experiments.write_to_files()
+        self._save_experiments()
 
     def add_to_experiment(self, experiment, group, release_name, *rest):
         logging.info('Adding group to experiment %s', experiment)
 
-        bismark_release = release.open_bismark_release(
-            self._release_path(release_name))
+        bismark_release = self._open_release(release_name)
         package = release.Package(*rest)
         located_package = bismark_release.locate_package(package)
         if located_package is None:
@@ -189,12 +327,12 @@ class BismarkReleasesTree(object):
 
         self._experiments[experiment].add_package(
             group, release_name, *rest)
-        self._experiments.write_to_files()
+        self._save_experiments()
 
     def remove_from_experiment(self, experiment, group, *rest):
         logging.info('Removing group from experiment %s', experiment)
         self._experiments[experiment].remove_package(group, *rest)
-        self._experiments.write_to_files()
+        self._save_experiments()
 
     def set_experiment_required(self, experiment, required, groups):
         logging.info('Set required to %r for experiment %r',
@@ -202,7 +340,7 @@ class BismarkReleasesTree(object):
                      experiment)
         for group in groups:
             self._experiments[experiment].set_required(group, required)
-        self._experiments.write_to_files()
+        self._save_experiments()
 
     def set_experiment_revoked(self, experiment, revoked, groups):
         logging.info('Set revoked to %r for experiment %r',
@@ -210,7 +348,7 @@ class BismarkReleasesTree(object):
                      experiment)
         for group in groups:
             self._experiments[experiment].set_revoked(group, revoked)
-        self._experiments.write_to_files()
+        self._save_experiments()
 
     def set_experiment_installed_by_default(self,
                                             experiment,
@@ -222,17 +360,19 @@ class BismarkReleasesTree(object):
         for group in groups:
             self._experiments[experiment].set_installed_by_default(group,
                                                                    installed)
-        self._experiments.write_to_files()
+        self._save_experiments()
 
     def _stage_changes(self):
         os.chdir(self._root)
         if not os.path.isdir('.git'):
             subprocess.check_call(['git', 'init'])
         patterns = [
+            'derived-groups/*',
             'experiments/*/*',
             'groups/*',
             'releases/*/architectures',
             'releases/*/builtin-packages',
+            'releases/*/controls/*',
             'releases/*/extra-packages',
             'releases/*/fingerprinted-images',
             'releases/*/fingerprinted-packages',
@@ -254,28 +394,67 @@ class BismarkReleasesTree(object):
         self._stage_changes()
         subprocess.call(['git', 'diff', '--cached'])
 
-    def deploy(self, destination, signing_key):
+    def deploy(self,
+               destination,
+               signing_key,
+               compare='checksum',
+               jobs=1,
+               atomic=False,
+               keep_versions=3,
+               keep_snapshots=5):
+        import deploy
         self.check_constraints()
-        node_groups = groups.NodeGroups(self._groups_path())
-        releases = []
-        for release_name in self.releases:
-            release_path = self._release_path(release_name)
-            bismark_release = release.open_bismark_release(release_path)
-            releases.append(bismark_release)
         deploy.deploy(self._root,
                       destination,
                       signing_key,
-                      releases,
+                      self._open_releases(),
                       self._experiments,
-                      node_groups)
+                      self._open_groups(),
+                      compare=compare,
+                      jobs=jobs,
+                      atomic=atomic,
+                      keep_versions=keep_versions,
+                      snapshots_root=self._deployments_path(),
+                      keep_snapshots=keep_snapshots)
+
+    def stage_deployment(self, signing_key, deployment_path=None):
+        import deploy
+        self.check_constraints()
+        return deploy.stage(self._root,
+                            signing_key,
+                            self._open_releases(),
+                            self._experiments,
+                            self._open_groups(),
+                            deployment_path=deployment_path)
+
+    def rollback_deploy(self,
+                        snapshot_id,
+                        destination,
+                        compare='checksum',
+                        jobs=1,
+                        atomic=False,
+                        keep_versions=3):
+        import deploy
+        deploy.rollback(self._deployments_path(),
+                        snapshot_id,
+                        destination,
+                        compare=compare,
+                        jobs=jobs,
+                        atomic=atomic,
+                        keep_versions=keep_versions)
+
+    @property
+    def deployment_snapshots(self):
+        import snapshots
+        return snapshots.Snapshots(self._deployments_path())
 
     def check_constraints(self):
         logging.info('Checking release constraints')
         for release_name in self.releases:
             logging.info('Checking constraints for release %r', release_name)
-            release_path = self._release_path(release_name)
-            bismark_release = release.open_bismark_release(release_path)
-            bismark_release.check_constraints()
+            bismark_release = self._open_release(release_name)
+            bismark_release.check_constraints(
+                self._experiment_packages(release_name))
 
             logging.info('Checking if experiments include builtin packages')
             for builtin_package in bismark_release.builtin_packages:
@@ -311,11 +490,105 @@ class BismarkReleasesTree(object):
 
         self._experiments.check_constraints()
 
+    def _open_releases(self):
+        releases = []
+        for release_name in sorted(self.releases):
+            releases.append(self._open_release(release_name))
+        return releases
+
+    @contextlib.contextmanager
+    def batch(self):
+        # Runs many commands against one in-memory copy of the tree. The
+        # constraints are checked and files written once, at the end; if a
+        # command or the check fails, every change in the batch is discarded.
+        if self._batching:
+            raise Exception('Batches cannot be nested')
+        self._batching = True
+        try:
+            try:
+                yield
+                self.check_constraints()
+            except:
+                logging.info('Discarding changes made by the batch')
+                for bismark_release in self._batch_releases.values():
+                    bismark_release.discard_imported_packages()
+                self._loaded_experiments = None
+                raise
+            logging.info('Saving changes made by the batch')
+            for name in sorted(self._batch_releases):
+                self._batch_releases[name].save(check=False)
+            if self._batch_groups is not None:
+                self._batch_groups.write_to_files()
+            if self._loaded_experiments is not None:
+                self._loaded_experiments.write_to_files(check=False)
+        finally:
+            self._batching = False
+            self._batch_releases = {}
+            self._batch_groups = None
+
+    def _open_release(self, release_name):
+        if release_name in self._batch_releases:
+            return self._batch_releases[release_name]
+        bismark_release = release.open_bismark_release(
+            self._release_path(release_name))
+        if self._batching:
+            self._batch_releases[release_name] = bismark_release
+        return bismark_release
+
+    def _save_release(self, bismark_release):
+        if not self._batching:
+            bismark_release.save(
+                experiment_packages=self._experiment_packages(
+                    bismark_release.name))
+
+    def _experiment_packages(self, release_name):
+        experiment_packages = set()
+        for _, experiment in self._experiments.iteritems():
+            for package in experiment.packages:
+                if package.release != release_name:
+                    continue
+                experiment_packages.add(release.Package(package.name,
+                                                        package.version,
+                                                        package.architecture))
+        return experiment_packages
+
+    def _open_groups(self):
+        if self._batch_groups is not None:
+            return self._batch_groups
+        node_groups = groups.NodeGroups(self._groups_path(),
+                                        self._derived_groups_path())
+        if self._batching:
+            self._batch_groups = node_groups
+        return node_groups
+
+    def _save_groups(self, node_groups):
+        if not self._batching:
+            node_groups.write_to_files()
+
+    def _save_experiments(self):
+        if not self._batching:
+            self._experiments.write_to_files()
+
     def _release_path(self, release_name):
         return os.path.join(self._root, 'releases', release_name)
 
     def _groups_path(self):
         return os.path.join(self._root, 'groups')
 
+    def _derived_groups_path(self):
+        return os.path.join(self._root, 'derived-groups')
+
     def _experiments_path(self):
         return os.path.join(self._root, 'experiments')
+
+    def _deployments_path(self):
+        return os.path.join(self._root, 'deployments')
+
+    def _cache_path(self):
+        return os.path.join(self._root, '.cache')
+
+    def _package_index_path(self):
+        return os.path.join(self._cache_path(), 'package-index')
+
+    def _verify_checkpoint_path(self):
+        return os.path.join(self._cache_path(), 'verify-checkpoint')
@@ -0,0 +1,133 @@
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+import hashlib
+import logging
+import math
+import multiprocessing
+import os
+import random
+
+import common
+
+# hashlib releases the GIL while hashing large buffers, so reading and hashing
+# blobs in threads keeps several disks and cores busy.
+_CHUNK_SIZE = 1 << 20
+
+Blob = namedtuple('Blob', ['release', 'kind', 'path', 'sha1'])
+
+VerifiedBlob = namedtuple('VerifiedBlob', ['release',
+                                           'kind',
+                                           'path',
+                                           'sha1',
+                                           'size',
+                                           'status'])
+
+
+def release_blobs(releases):
+    blobs = []
+    for bismark_release in releases:
+        for package in sorted(bismark_release.packages):
+            blobs.append(Blob(bismark_release.name,
+                              'package',
+                              os.path.join(bismark_release.packages_path,
+                                           '%s.ipk' % package.sha1),
+                              package.sha1))
+        for image in sorted(bismark_release.images):
+            blobs.append(Blob(bismark_release.name,
+                              'image',
+                              os.path.join(bismark_release.images_path,
+                                           image.name),
+                              image.sha1))
+    return blobs
+
+
+def sample_blobs(blobs, percent):
+    count = int(math.ceil(len(blobs) * percent / 100.0))
+    return sorted(random.sample(blobs, min(count, len(blobs))))
+
+
+def _checkpoint_key(blob, stat):
+    return '%s\t%s\t%d\t%r' % (blob.path, blob.sha1, stat.st_size,
+                               stat.st_mtime)
+
+
+def _read_checkpoint(filename):
+    try:
+        with open(filename) as handle:
+            return set(line.rstrip('\n') for line in handle)
+    except IOError:
+        return set()
+
+
+def _verify_blob(blob):
+    try:
+        stat = os.stat(blob.path)
+        hasher = hashlib.sha1()
+        with open(blob.path, 'rb') as handle:
+            while True:
+                chunk = handle.read(_CHUNK_SIZE)
+                if not chunk:
+                    break
+                hasher.update(chunk)
+    except (IOError, OSError):
+        return blob, None, 'missing'
+    if hasher.hexdigest() != blob.sha1:
+        return blob, stat, 'mismatch'
+    return blob, stat, 'ok'
+
+
+# Verifies blobs in a pool of jobs threads, yielding a VerifiedBlob as each
+# finishes. Verified blobs are appended to the checkpoint file as they
+# finish; with resume, blobs in the checkpoint that haven't changed size or
+# modification time since are skipped. complete says whether blobs are all
+# the blobs in the tree: only then is the checkpoint started afresh (without
+# resume) or removed once every blob verifies, so a sampled or single-release
+# run never loses an interrupted full run's progress.
+def verify_blobs(blobs, checkpoint_filename, jobs=None, resume=False,
+                 complete=True):
+    if resume:
+        checkpoint = _read_checkpoint(checkpoint_filename)
+    else:
+        checkpoint = set()
+
+    remaining = []
+    for blob in blobs:
+        try:
+            stat = os.stat(blob.path)
+        except OSError:
+            remaining.append(blob)
+            continue
+        if _checkpoint_key(blob, stat) in checkpoint:
+            yield VerifiedBlob(*blob, size=stat.st_size, status='skipped')
+        else:
+            remaining.append(blob)
+    logging.info('Verifying %d of %d blobs', len(remaining), len(blobs))
+
+    common.makedirs(os.path.dirname(checkpoint_filename))
+    failed = False
+    if jobs is None:
+        jobs = multiprocessing.cpu_count()
+    pool = ThreadPool(max(1, jobs))
+    try:
+        if complete and not resume:
+            mode = 'w'
+        else:
+            mode = 'a'
+        with open(checkpoint_filename, mode) as handle:
+            for blob, stat, status in pool.imap_unordered(_verify_blob,
+                                                          remaining):
+                if status == 'ok':
+                    handle.write(_checkpoint_key(blob, stat) + '\n')
+                    handle.flush()
+                else:
+                    failed = True
+                if stat is None:
+                    size = 0
+                else:
+                    size = stat.st_size
+                yield VerifiedBlob(*blob, size=size, status=status)
+    finally:
+        pool.terminate()
+        pool.join()
+    if complete and not failed:
+        os.remove(checkpoint_filename)